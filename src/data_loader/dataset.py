@@ -1,4 +1,3 @@
-import pickle
 
 import mne
 import torch
@@ -15,6 +14,10 @@ from scipy.signal import detrend
 from torch.utils.data import Dataset
 
 from src.visualization.visualization_utils import plot_histogram
+from src.data_loader.epoching import nearest_sample_index, extract_epochs
+from src.data_loader.epoch_store import epoch_store_exists, save_epoch_store, load_epoch_store
+from src.data_loader.hdf5_data import HDF5EEGData
+from src.data_preprocess.streaming_preprocessor import StreamingPreprocessor
 from ieeg_data_loader.data import iEEGDataLoader
 import h5py
 
@@ -122,6 +125,9 @@ class CLEARDataLoader(AbstractEEGDataLoader):
 
 
 class PilotEEGDataLoader(AbstractEEGDataLoader):
+    word_block_types = ['w+e', 'w-e', 'w+e+x', 'w-e+x']
+    image_block_types = ['i+e', 'i-e', 'i+e+x', 'i-e+x']
+
     def __init__(self, paths, settings):
         super().__init__(paths, settings)
         self.channel_groups = scipy.io.loadmat(self.channel_group_file)['ChGrp'][0]
@@ -167,18 +173,41 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
             # Attempt to load HD5 file if available
             dataset = self.load_hd5_file(file_name)
             if dataset is None:
-                prepaired_data_path = self.paths.raw_dataset_path + file_name.split('.')[0] + "_trials.pkl"
-                if os.path.exists(prepaired_data_path) and self.settings.load_epoched_data is True:
-                    with open(prepaired_data_path, 'rb') as file:
-                        dataset = pickle.load(file)
+                prepaired_data_path = self.paths.raw_dataset_path + file_name.split('.')[0] + "_trials"
+                if epoch_store_exists(prepaired_data_path) and self.settings.load_epoched_data is True:
+                    dataset = EEGDataSet.load_from_epoch_store(prepaired_data_path)
                 else:
-                    dataset = self.load_single_patient_data(file_name)
+                    dataset = self.load_single_patient_data(
+                        file_name, stream_block_seconds=self.settings.stream_block_seconds)
                     if self.settings.save_epoched_data is True:
-                        dataset.save_to_pickle(
-                            file_path=self.paths.raw_dataset_path + file_name.split('.')[0] + "_trials.pkl")
+                        dataset.save_to_epoch_store(prepaired_data_path)
+                        # Reopen the saved epochs memory-mapped to release the in-memory copy
+                        dataset = EEGDataSet.load_from_epoch_store(prepaired_data_path)
             self.all_patient_data[file_name.split('.')[0]] = dataset
 
-    def load_single_patient_data(self, data, dgd_outputs=None, preprocess_continuous_data=False):
+    def load_single_patient_data(self, data, dgd_outputs=None, preprocess_continuous_data=False,
+                                 stream_block_seconds=None):
+        """
+        Load the continuous recording of a patient and cut it into trials.
+
+        Parameters
+        ----------
+        data : str
+            The name of the XDF file of the patient.
+        dgd_outputs : None
+            Unused.
+        preprocess_continuous_data : bool
+            If True, the continuous data are filtered between 1 and 60 Hz and the line noise is removed.
+        stream_block_seconds : float or None
+            If given, the continuous data are preprocessed in blocks of this length and the trials are written
+            straight into the epoch store of the recording (see StreamingPreprocessor), without in-memory copies
+            of the whole recording. The continuous data are then not detrended.
+
+        Returns
+        -------
+        EEGDataSet
+            The trials of the patient.
+        """
         file_name = data
 
         file_path = os.path.join(self.data_directory, file_name)
@@ -218,13 +247,24 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
         plt.show()
 
         keep_indices = [i for i, name in enumerate(channel_names) if "AUX" not in name and "Trig" not in name]
-        # Filter the EEG data to remove channels with "AUX" in their names
-        eeg_data = eeg_data[keep_indices, :]
-
-        # Also, filter the channel names list
+        # Filter the channel names list to remove channels with "AUX" in their names
         channel_names = [name for i, name in enumerate(channel_names) if i in keep_indices]
 
-        if eeg_data.shape[0] != len(channel_names):
+        preprocessor = None
+        if stream_block_seconds is not None:
+            # The channels are selected and the data preprocessed block by block while the trials are cut
+            filter_configs = {}
+            if preprocess_continuous_data is True:
+                filter_configs = {'band_pass_filter': {'low_cutoff': 1.0, 'high_cutoff': 60},
+                                  'remove_line_noise': {'line_frequency': 60, 'n_harmonics': 0, 'quality': 60}}
+            preprocessor = StreamingPreprocessor(filter_configs, s_rate, phase='zero', normalize=True,
+                                                 block_seconds=stream_block_seconds)
+            preprocess_continuous_data = False
+        else:
+            # Filter the EEG data to remove channels with "AUX" in their names
+            eeg_data = eeg_data[keep_indices, :]
+
+        if preprocessor is None and eeg_data.shape[0] != len(channel_names):
             eeg_data = eeg_data.T  # Transpose if necessary
 
             # Create an Info object
@@ -244,8 +284,9 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
 
             eeg_data = np.apply_along_axis(detrend, axis=1, arr=eeg_data)
 
-        eeg_data = eeg_data / np.quantile(np.abs(eeg_data), 0.99, axis=-1, keepdims=True)
-        eeg_data = eeg_data - np.mean(eeg_data, axis=-1, keepdims=True)
+        if preprocessor is None:
+            eeg_data = eeg_data / np.quantile(np.abs(eeg_data), 0.99, axis=-1, keepdims=True)
+            eeg_data = eeg_data - np.mean(eeg_data, axis=-1, keepdims=True)
 
         """
         fig, axs = plt.subplots(4, 4, figsize=(20, 10))
@@ -270,7 +311,9 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
             file_name=file_name,
             formatted_marker_df=formatted_marker_df,
             save_data=True,
-            load_trialed_data=False)
+            load_trialed_data=False,
+            preprocessor=preprocessor,
+            channels=keep_indices if preprocessor is not None else None)
 
         plot_histogram(trial_length, xlabel='Length trial (second)', ylabel='Number of Trials',
                        title=f"Histogram of Trial lengths for subject {file_name.split('_')[0]}")
@@ -298,15 +341,36 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
 
         return dataset
 
-    def decode_marker(self, marker):
-        parts = marker.decode('utf-8').split('-')
-        if len(parts) != 4:
-            raise ValueError(f"Unexpected marker format: {marker}")
-        return parts[0], parts[1], parts[2], parts[3]
+    @staticmethod
+    def decode_markers(markers):
+        """
+        Decode the "<word/image>-<exp/noexp>-<go/nogo>-<correct>" trial markers of an HDF5 label table.
+
+        Parameters
+        ----------
+        markers : numpy.ndarray
+            The byte-string markers of all trials.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One column per marker field.
+        """
+        markers = pd.Series(markers).str.decode('utf-8')
+        invalid = markers.str.count('-') != 3
+        if invalid.any():
+            raise ValueError(f"Unexpected marker format: {markers[invalid].iloc[0]}")
+        parts = markers.str.split('-', expand=True)
+        parts.columns = ['wrd_img', 'exp_noexp', 'go_nogo', 'correct']
+        return parts
+
     def load_hd5_file(self, patient_id):
         """
         Load HD5 file if available.
 
+        The EEG data are not read here: the returned dataset holds a lazy HDF5EEGData array that reads the
+        requested trial, channel and time slices from the file on demand.
+
         Parameters
         ----------
         patient_id : str
@@ -320,42 +384,34 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
         hd5_file_path = os.path.join(self.data_directory, f"{patient_id}")
         if os.path.exists(hd5_file_path):
             print(f"Loading H5 file for patient {patient_id}")
-            file = h5py.File(hd5_file_path, 'r')
+            eeg_data = HDF5EEGData(hd5_file_path, 'chunks/eeg/block/data')
 
-            # Explore the structure of the file
-            print("Keys: %s" % file.keys())
-            eeg_data = np.squeeze(file['chunks']['eeg']['block']['data'])
-            eeg_data = np.transpose(eeg_data, (0, 2, 1))
+            with h5py.File(hd5_file_path, 'r') as file:
+                # Explore the structure of the file
+                print("Keys: %s" % file.keys())
+                block_axes = file['chunks']['eeg']['block']['axes']
+                eeg_times = np.squeeze(block_axes['axis1']['times'][()])
 
-            eeg_times = np.squeeze(file['chunks']['eeg']['block']['axes']['axis1']['times'])
+                # Access and decode channel names
+                channel_names = [name.decode('utf-8') for name in block_axes['axis2']['names'][()]]
 
-            # Access and decode channel names
-            channel_names_raw = file['chunks']['eeg']['block']['axes']['axis2']['names']
-            channel_names = [name.decode('utf-8') for name in channel_names_raw]
+                labels_data = block_axes['axis0']['data'][()]
 
             # Print shapes and types to verify
             print(f"EEG data shape: {eeg_data.shape}")
             print(f"EEG times shape: {eeg_times.shape}")
             print(f"Number of channels: {len(channel_names)}")
 
-            labels_data = np.array(file['chunks']['eeg']['block']['axes']['axis0']['data'])
-            # Function to decode the first element
-
-
-            processed_data = []
-            for entry in labels_data:
-                wrd_img, exp_noexp, go_nogo, correct = self.decode_marker(entry['Marker'])
-                target_value = entry['TargetValue']
-                is_correct = entry['IsGood']
-                trial_index = entry['TrialIndex']
-                target_trial_index_asc = entry['TargetTrialIndexAsc']
-                processed_data.append(
-                    (go_nogo, exp_noexp, wrd_img, target_value, is_correct, trial_index, target_trial_index_asc))
-
-            # Creating DataFrame
-            df_target = pd.DataFrame(processed_data,
-                              columns=['go_nogo', 'is_experienced', 'Wrd_Img', 'TargetValue', 'is_correct', 'TrialIndex',
-                                       'target_trial_index_asc'])
+            markers = self.decode_markers(labels_data['Marker'])
+            df_target = pd.DataFrame({
+                'go_nogo': markers['go_nogo'],
+                'is_experienced': markers['exp_noexp'],
+                'Wrd_Img': markers['wrd_img'],
+                'TargetValue': labels_data['TargetValue'],
+                'is_correct': labels_data['IsGood'],
+                'TrialIndex': labels_data['TrialIndex'],
+                'target_trial_index_asc': labels_data['TargetTrialIndexAsc']
+            })
 
             dataset = EEGDataSet()
             dataset.data = eeg_data
@@ -383,184 +439,89 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
             column_name = marker_df.columns.to_list()
             if 'event' not in column_name:
                 marker_df.rename(columns={column_name[0]: 'event', column_name[1]: 'time'}, inplace=True)
-
-            # Initialize a trial index column
-            marker_df['trial_index'] = None
-
-            # Variable to keep track of the current trial index
-            current_trial_index = None
-
-            # Initialize a trial index, block index and block type column
-            marker_df['trial_index'], marker_df['block_index'], marker_df['block_type'] = None, None, None
-
-            # Variable to keep track of the current trial index
-            current_trial_index, current_block_index, current_block_type = None, None, None
-
-            # Iterate through the DataFrame to assign trial index based on "block-begin-x" events
-            for index, row in marker_df.iterrows():
-                if 'subject_id' in row['event'] and subject_group is None:
-                    subject_group = row['event'].split(':')[-1].replace(' ', '')
-                if 'trial-begin' in row['event']:
-                    # Extract the trial index from the event string
-                    current_trial_index = int(row['event'].split('-')[-1])
-
-                if 'block-begin' in row['event']:
-                    # Extract the trial index from the event string
-                    current_block_index = int(row['event'].split('-')[2])
-
-                    if 'type' in row['event']:
-                        current_block_type = row['event'].split('_')[-1]
-                        marker_df.at[index, 'block_type'] = current_block_type
-                    else:
-                        raise ValueError("Can not locate the block type")
-                marker_df.at[index, 'trial_index'] = current_trial_index
-                marker_df.at[index, 'block_index'] = current_block_index
-                marker_df.at[index, 'block_type'] = current_block_type
-
-            marker_df['subject_group'] = subject_group
-            marker_df['stim'] = None
-            marker_df['stim_indicator'] = None
-            marker_df['go_nogo'] = None
-            marker_df['exp_label'] = None
-            marker_df['is_resp'] = None
-            marker_df['is_correct'] = None
-            marker_df['response_time'] = None
-            marker_df['block_type'] = None
-            marker_df['stim_desc'] = None
-            for index, row in marker_df.iterrows():
-                if 'stim_' in row['event']:
-                    stim_type = row['event'].split('_')[1]
-                    block_type = row['event'].split('_')[2]
-                    task_type = row['event'].split('_')[3]
-                    stim_desc = row['event'].split('_')[4]
-
-                    if stim_type in ['stp', 'msp', 'ctl']:
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'stim'] = stim_type
-                    else:
-                        raise ValueError(f"Stim type mismatch: {stim_type} in {row['event']}")
-
-                    if block_type in ['w+e', 'w-e', 'w+e+x', 'w-e+x']:
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'stim_indicator'] = 'word'
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'block_type'] = block_type
-                    elif block_type in ['i+e', 'i-e', 'i+e+x', 'i-e+x']:
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'stim_indicator'] = 'image'
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'block_type'] = block_type
-                    else:
-                        raise ValueError(f"Block type type mismatch: {block_type} in {row['event']}")
-
-                    if task_type in ['nogo', 'go']:
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'go_nogo'] = task_type
-                    else:
-                        raise ValueError(f"task type mismatch: {task_type} in {row['event']}")
-
-                    marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'stim_desc'] = stim_desc
-
-                if 'resp_' in row['event']:
-                    is_resp = row['event'].split('_')[-1]
-                    is_correct = row['event'].split('_')[-2]
-
-                    if is_resp in ['noresp']:
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'is_resp'] = False
-                    elif is_resp.isdigit():
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'is_resp'] = True
-                        marker_df.loc[marker_df['trial_index'] == row['trial_index'], 'response_time'] = float(is_resp)
-                    else:
-                        raise ValueError(f"is_resp mismatch: {is_resp} in {row['event']}")
-
-                    if is_correct in ['correct', 'incorrect']:
-                        marker_df.loc[
-                            marker_df['trial_index'] == row['trial_index'], 'is_correct'] = is_correct == 'correct'
-                    else:
-                        raise ValueError(f"is_correct mismatch: {is_correct} in {row['event']}")
-
-            marker_df = marker_df.dropna(subset=['trial_index'])
-            grouped = marker_df.groupby('trial_index')
-
-            # Create a new DataFrame to hold the reformatted data
-            formatted_data = pd.DataFrame()
-
-            # Define the columns for the new DataFrame
-            formatted_columns = ['trial_number', 'block_number', 'block_type', 'stim_indicator', 'subject_group',
-                                 'stim', 'go_nogo', 'is_experienced', 'is_resp', 'is_correct', 'response_time',
-                                 'response_time_real', 'trial_begin_time', 'stim_time',
-                                 'trial_end_time', 'stim_desc', 'stim_type_info']
-
-            # Initialize these columns in the formatted DataFrame
-            for col in formatted_columns:
-                formatted_data[col] = None
-
-            # Iterate over each group, extract the times, and populate the new DataFrame
-            for name, group in grouped:
-                trial_index = int(name)
-                trial_begin_time = group[group['event'].str.contains('trial-begin')]['time'].values[0]
-                stim_time = group[group['event'].str.contains('stim')]['time'].values[0]
-                trial_end_time = group[group['event'].str.contains('trial-end')]['time'].values[0]
-                response_time = group['response_time'].values[0]
-
-                """
-                try:
-                    response_time = group[group['event'].str.contains('response-received')]['time'].values[0]
-                except:
-                    response_time = None
-                """
-
-                stim_indicator = group['stim_indicator'].values[0]  # Assuming this value is constant within each trial
-                go_nogo = group['go_nogo'].values[0]  # Assuming this value is constant within each trial
-                is_resp = group['is_resp'].values[0]  # Assuming this value is constant within each trial
-                is_correct = group['is_correct'].values[0]  # Assuming this value is constant within each trial
-                block_type = group['block_type'].values[0]
-                block_number = int(group['block_index'].values[0])
-                stim = group['stim'].values[0]
-                stim_desc = group['stim_desc'].values[0]
-                is_experienced = stim == subject_group
-
-                stim_row = group[group['event'].str.contains('stim_')].iloc[0] if not group[
-                    group['event'].str.contains('stim_')].empty else None
-                img_or_word_row = group[(group['event'].str.contains('img-')) | (group['event'].str.contains('word-'))]
-                img_or_word_row = img_or_word_row['event'].values
-                if len(img_or_word_row) == 0:
-                    img_or_word_row = None
-
-                # Add the row to the new DataFrame
-                new_trial_row = {
-                    'trial_number': trial_index,
-                    'block_number': block_number,
-                    'block_type': block_type,
-                    'stim_indicator': stim_indicator,
-                    'subject_group': subject_group,
-                    'stim': stim,
-                    'go_nogo': go_nogo,
-                    'is_experienced': is_experienced,
-                    'is_resp': is_resp,
-                    'is_correct': is_correct,
-                    'response_time': trial_end_time - stim_time,
-                    'response_time_real': response_time,
-                    'trial_begin_time': trial_begin_time,
-                    'stim_time': stim_time,
-                    'trial_end_time': trial_end_time,
-                    'stim_desc': stim_row['event'],
-                    'stim_type_info': stim_desc
-                }
-                for col in formatted_data.columns:
-                    if formatted_data[col].dtype == 'object' and all(
-                            isinstance(val, bool) for val in formatted_data[col].dropna()):
-                        formatted_data[col] = formatted_data[col].astype(bool)
-                new_trial_df = pd.DataFrame([new_trial_row.values()],
-                                            columns=list(new_trial_row.keys()))
-                formatted_data = pd.concat([formatted_data, new_trial_df], ignore_index=True)
-
+            events = marker_df['event'].astype(str)
+
+            if subject_group is None:
+                subject_events = events[events.str.contains('subject_id', regex=False)]
+                if len(subject_events) > 0:
+                    subject_group = subject_events.iloc[0].split(':')[-1].replace(' ', '')
+
+            # Each event belongs to the trial and block of the last "trial-begin-x" and "block-begin-x" events
+            is_trial_begin = events.str.contains('trial-begin', regex=False)
+            is_block_begin = events.str.contains('block-begin', regex=False)
+            if (is_block_begin & ~events.str.contains('type', regex=False)).any():
+                raise ValueError("Can not locate the block type")
+            trial_index = events.where(is_trial_begin).str.split('-').str[-1].astype(float).ffill()
+            block_index = events.where(is_block_begin).str.split('-').str[2].astype(float).ffill()
+
+            # Parse the stimulus events: stim_<stim>_<block type>_<go/nogo>_<description>
+            is_stim_event = events.str.contains('stim_', regex=False)
+            stim_events = events[is_stim_event]
+            stim_fields = stim_events.str.split('_')
+            stim = self._check_marker_values(stim_fields.str[1], ['stp', 'msp', 'ctl'], stim_events,
+                                             "Stim type mismatch")
+            block_type = self._check_marker_values(stim_fields.str[2], self.word_block_types + self.image_block_types,
+                                                   stim_events, "Block type type mismatch")
+            go_nogo = self._check_marker_values(stim_fields.str[3], ['nogo', 'go'], stim_events,
+                                                "task type mismatch")
+
+            # Parse the response events: resp_..._<correct/incorrect>_<response time or noresp>
+            resp_events = events[events.str.contains('resp_', regex=False)]
+            resp_fields = resp_events.str.split('_')
+            is_resp = resp_fields.str[-1]
+            has_response_time = is_resp.str.isdigit().fillna(False).astype(bool)
+            if not (has_response_time | (is_resp == 'noresp')).all():
+                index = (~(has_response_time | (is_resp == 'noresp'))).idxmax()
+                raise ValueError(f"is_resp mismatch: {is_resp[index]} in {resp_events[index]}")
+            is_correct = self._check_marker_values(resp_fields.str[-2], ['correct', 'incorrect'], resp_events,
+                                                   "is_correct mismatch")
+
+            # The labels of a trial are taken from its last stimulus and response events
+            event_labels = pd.DataFrame({
+                'stim': stim,
+                'block_type': block_type,
+                'stim_indicator': block_type.isin(self.word_block_types).map({True: 'word', False: 'image'}),
+                'go_nogo': go_nogo,
+                'stim_desc': stim_fields.str[4],
+                'is_resp': has_response_time,
+                'is_correct': is_correct == 'correct',
+                'response_time': is_resp.where(has_response_time).astype(float)
+            }, index=marker_df.index)
+            trial_labels = event_labels.groupby(trial_index).last()
+
+            event_time = marker_df['time']
+            trial_begin_time = event_time.where(is_trial_begin).groupby(trial_index).first()
+            stim_time = event_time.where(events.str.contains('stim', regex=False)).groupby(trial_index).first()
+            trial_end_time = event_time.where(events.str.contains('trial-end', regex=False)).groupby(
+                trial_index).first()
+            is_first_event = trial_index.notna() & ~trial_index.duplicated()
+            block_number = block_index[is_first_event].set_axis(trial_index[is_first_event])
+
+            formatted_data = pd.DataFrame({
+                'block_number': block_number.astype(int),
+                'block_type': trial_labels['block_type'],
+                'stim_indicator': trial_labels['stim_indicator'],
+                'subject_group': subject_group,
+                'stim': trial_labels['stim'],
+                'go_nogo': trial_labels['go_nogo'],
+                'is_experienced': trial_labels['stim'] == subject_group,
+                'is_resp': trial_labels['is_resp'].eq(True),
+                'is_correct': trial_labels['is_correct'].eq(True),
+                'response_time': trial_end_time - stim_time,
+                'response_time_real': trial_labels['response_time'],
+                'trial_begin_time': trial_begin_time,
+                'stim_time': stim_time,
+                'trial_end_time': trial_end_time,
+                'stim_desc': events.where(is_stim_event).groupby(trial_index).first(),
+                'stim_type_info': trial_labels['stim_desc']
+            })
+            formatted_data.insert(0, 'trial_number', formatted_data.index.astype(int))
             formatted_data.reset_index(drop=True, inplace=True)
-            formatted_data['trial_number'] = pd.to_numeric(formatted_data['trial_number'],
-                                                           errors='coerce')  # This will convert to numeric and set errors to NaN
-            test_data_sorted = formatted_data.dropna(subset=['trial_number']).sort_values(
-                by='trial_number')  # Drop rows where trial_index could not be converted
-            test_data_sorted.set_index('trial_number', inplace=True)
             formatted_data.to_csv(self.data_directory + file_name.split('.')[0] + '_reformatted.csv', index=False)
 
             unique_blocks = formatted_data['block_number'].nunique()
-            unique_block_types = [
-                str(formatted_data[formatted_data['block_number'] == block_idx]['block_type'].unique()) for
-                block_idx in formatted_data['block_number'].unique()]
+            unique_block_types = [str(block_types) for block_types in
+                                  formatted_data.groupby('block_number', sort=False)['block_type'].unique()]
             total_trials = formatted_data.shape[0]
 
             print(
@@ -568,103 +529,76 @@ class PilotEEGDataLoader(AbstractEEGDataLoader):
 
         return formatted_data
 
+    @staticmethod
+    def _check_marker_values(values, valid_values, events, message):
+        invalid = ~values.isin(valid_values)
+        if invalid.any():
+            index = invalid.idxmax()
+            raise ValueError(f"{message}: {values[index]} in {events[index]}")
+        return values
+
     def _convert_continuous_to_trial(self, eeg_times, eeg_data, s_rate, formatted_marker_df, file_name,
                                      load_trialed_data=False,
-                                     save_data=False):
+                                     save_data=False, preprocessor=None, channels=None):
+        trial_data_path = self.data_directory + file_name.split('.')[0] + '_trial_data'
         if load_trialed_data is True:
-            with open(self.data_directory + file_name.split('.')[0] + '_trial_data.pkl', 'rb') as file:
-                data_loaded = pickle.load(file)
+            eeg_data_array, data_loaded = load_epoch_store(trial_data_path)
 
-            # Extract variables from the loaded dictionary
-            eeg_data_array = data_loaded['eeg_data_array']
+            # Extract variables from the loaded metadata
             eeg_time = data_loaded['eeg_time']
             eeg_labels = data_loaded['eeg_labels']
             trial_length = data_loaded['trial_length']
             trial_index = data_loaded['trial_index']
         else:
-            trial_begin_times = formatted_marker_df['trial_begin_time']
-            trial_onset_times = formatted_marker_df['stim_time']
-            trial_response_times = formatted_marker_df['response_time']
-            trial_end_times = formatted_marker_df['trial_end_time']
-
-            trial_length = trial_end_times - trial_onset_times
-
-            eeg_data_list, trial_index = [], []
-            real_time, relative_time = [], []
-            trial_length = []
-            eeg_labels = {
-                'block_number': [],
-                'block_type': [],
-                'stim_indicator': [],
-                'go_nogo': [],
-                'is_experienced': [],
-                'is_resp': [],
-                'is_correct': [],
-                'stim': []
-            }
-
             eeg_time = np.arange(int(- 2 * s_rate), int(s_rate)) / s_rate
 
-            error_list = []
-            for index, row in formatted_marker_df.iterrows():
-                trial_begin_time = row['trial_begin_time']
-                trial_onset_time = row['stim_time']
-                trial_response_time = row['response_time']
-                trial_end_time = row['trial_end_time']
-
-                idx_start = np.argmin(np.abs(eeg_times - trial_begin_time))
-                idx_end = np.argmin(np.abs(eeg_times - trial_end_time))
-                idx_stim = np.argmin(np.abs(eeg_times - trial_onset_time))
-
-                tl = (idx_end - idx_stim) / s_rate
-                if tl < 0.8 * row['response_time']:
-                    print(
-                        f"Segmentation Error: The matched segment with Trial {row['trial_number']} has task duration "
-                        f"{tl} which is less that expected duration {row['response_time']} ")
-                    error_list.append(index)
-                else:
-                    eeg_labels['block_number'].append(row['block_number'])
-                    eeg_labels['block_type'].append(row['block_type'])
-                    eeg_labels['stim_indicator'].append(row['stim_indicator'])
-                    eeg_labels['go_nogo'].append(row['go_nogo'])
-                    eeg_labels['is_experienced'].append(row['is_experienced'])
-                    eeg_labels['is_resp'].append(row['is_resp'])
-                    eeg_labels['is_correct'].append(row['is_correct'])
-                    eeg_labels['stim'].append(row['stim'])
-
-                    trial_length.append((idx_end - idx_stim) / s_rate)
-
-                    idx_start = int(idx_stim - 2 * s_rate)
-                    idx_end = int(idx_stim + s_rate)
-
-                    eeg_data_list.append(eeg_data[:, idx_start:idx_end])
-                    real_time.append(eeg_times[idx_start:idx_end])
-
-                    trial_index.append(row['trial_number'])
-
-            eeg_data_array = np.stack(eeg_data_list)
+            # Match the marker times of all trials to the closest EEG samples at once
+            idx_stim = nearest_sample_index(eeg_times, formatted_marker_df['stim_time'].values)
+            idx_end = nearest_sample_index(eeg_times, formatted_marker_df['trial_end_time'].values)
+
+            task_length = (idx_end - idx_stim) / s_rate
+            is_segmentation_error = task_length < 0.8 * formatted_marker_df['response_time'].values
+            for trial_number, tl, response_time in zip(
+                    formatted_marker_df['trial_number'].values[is_segmentation_error],
+                    task_length[is_segmentation_error],
+                    formatted_marker_df['response_time'].values[is_segmentation_error]):
+                print(f"Segmentation Error: The matched segment with Trial {trial_number} has task duration "
+                      f"{tl} which is less that expected duration {response_time} ")
+
+            valid_trials = formatted_marker_df[~is_segmentation_error]
+            eeg_labels = {column: valid_trials[column].to_list() for column in
+                          ['block_number', 'block_type', 'stim_indicator', 'go_nogo', 'is_experienced', 'is_resp',
+                           'is_correct', 'stim']}
+            trial_length = task_length[~is_segmentation_error].tolist()
+            trial_index = valid_trials['trial_number'].to_list()
+
+            # Each epoch spans from 2 seconds before to 1 second after the stimulus
+            idx_stim = idx_stim[~is_segmentation_error]
+            idx_start = (idx_stim - 2 * s_rate).astype(int)
+            epoch_length = int(idx_stim[0] + s_rate) - idx_start[0] if len(idx_stim) > 0 else len(eeg_time)
+            metadata = {
+                'eeg_time': eeg_time,
+                'eeg_labels': eeg_labels,
+                'trial_length': trial_length,
+                'trial_index': trial_index
+            }
+            if preprocessor is not None:
+                # Preprocess the continuous data block by block and write the epochs straight into the store
+                eeg_data_array = preprocessor.process(eeg_data, idx_start, epoch_length, trial_data_path,
+                                                      metadata=metadata, channels=channels)
+            else:
+                eeg_data_array = extract_epochs(eeg_data, idx_start, epoch_length)
 
             unique_blocks = np.unique(eeg_labels['block_number'])
-            df = pd.DataFrame(eeg_labels)
-            unique_block_types = [
-                str(df[df['block_number'] == block_idx]['block_type'].unique()) for
-                block_idx in df['block_number'].unique()]
+            unique_block_types = [str(block_types) for block_types in
+                                  valid_trials.groupby('block_number', sort=False)['block_type'].unique()]
             total_trials = eeg_data_array.shape[0]
             print(
                 f"The trialed data contains {len(unique_blocks)} blocks ({', '.join(unique_block_types)}) and {total_trials} trials")
 
-            if save_data is True:
-                data_to_save = {
-                    'eeg_data_array': eeg_data_array,
-                    'eeg_time': eeg_time,
-                    'eeg_labels': eeg_labels,
-                    'trial_length': trial_length,
-                    'trial_index': trial_index
-                }
-
-                # Save the dictionary into a file
-                with open(self.data_directory + file_name.split('.')[0] + '_trial_data.pkl', 'wb') as file:
-                    pickle.dump(data_to_save, file)
+            if save_data is True and preprocessor is None:
+                # Save the epochs and their metadata into an epoch store
+                save_epoch_store(trial_data_path, eeg_data_array, metadata)
 
         return eeg_data_array, eeg_time, eeg_labels, trial_length, trial_index
 
@@ -1044,9 +978,43 @@ class EEGDataSet:
 
         return epochs
 
-    def save_to_pickle(self, file_path):
-        with open(file_path, 'wb') as file:
-            pickle.dump(self, file)
+    def save_to_epoch_store(self, store_path):
+        """
+        Save the dataset to an epoch store.
+
+        The EEG data are written as a raw data block and all the other attributes to the metadata sidecar.
+
+        Parameters
+        ----------
+        store_path : str
+            The path of the store without extension.
+        """
+        metadata = {key: value for key, value in vars(self).items()
+                    if key not in ('data', '_EEGDataSet__mne_data')}
+        save_epoch_store(store_path, self.data, metadata)
+
+    @classmethod
+    def load_from_epoch_store(cls, store_path, mmap_mode='c'):
+        """
+        Open a dataset saved with save_to_epoch_store.
+
+        Parameters
+        ----------
+        store_path : str
+            The path of the store without extension.
+        mmap_mode : {None, 'r', 'r+', 'c'}
+            The memory-map mode of the EEG data; by default the data are memory-mapped and read lazily.
+
+        Returns
+        -------
+        EEGDataSet
+            The dataset, with the EEG data memory-mapped from the store.
+        """
+        dataset = cls()
+        dataset.data, metadata = load_epoch_store(store_path, mmap_mode=mmap_mode)
+        for key, value in metadata.items():
+            setattr(dataset, key, value)
+        return dataset
 
 
 class TorchEEGDataset(Dataset):
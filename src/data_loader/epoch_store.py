@@ -0,0 +1,112 @@
+import os
+import pickle
+
+import numpy as np
+
+DATA_FILE_EXTENSION = '.npy'
+METADATA_FILE_EXTENSION = '.meta.pkl'
+
+
+def epoch_store_exists(store_path):
+    """
+    Check whether an epoch store has been written.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the store without extension.
+
+    Returns
+    -------
+    bool
+        True if both the data block and the metadata sidecar exist.
+    """
+    return (os.path.exists(store_path + DATA_FILE_EXTENSION) and
+            os.path.exists(store_path + METADATA_FILE_EXTENSION))
+
+
+def save_epoch_store(store_path, data, metadata=None):
+    """
+    Save an array of epochs to an epoch store.
+
+    The data are written as a raw .npy block that can be memory-mapped on load, and everything else (labels,
+    times, channel names, ...) goes to a small metadata sidecar.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the store without extension.
+    data : numpy.ndarray
+        The epoch data, e.g. with shape (trials, channels, samples).
+    metadata : dict or None
+        The metadata stored next to the data.
+    """
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    # The sidecar is written last so that a store interrupted while writing the data is not considered complete
+    np.save(store_path + DATA_FILE_EXTENSION, np.ascontiguousarray(data))
+    save_epoch_metadata(store_path, metadata)
+
+
+def create_epoch_store(store_path, shape, dtype=np.float32):
+    """
+    Allocate the data block of an epoch store on disk, to be filled in place.
+
+    The store is complete once its metadata have been written with save_epoch_metadata. An existing sidecar is
+    removed first so that a store being rewritten is not considered complete.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the store without extension.
+    shape : tuple of int
+        The shape of the epoch data, e.g. (trials, channels, samples).
+    dtype : numpy.dtype
+        The type of the epoch data.
+
+    Returns
+    -------
+    numpy.memmap
+        The writable, memory-mapped data block.
+    """
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    if os.path.exists(store_path + METADATA_FILE_EXTENSION):
+        os.remove(store_path + METADATA_FILE_EXTENSION)
+    return np.lib.format.open_memmap(store_path + DATA_FILE_EXTENSION, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def save_epoch_metadata(store_path, metadata=None):
+    """
+    Write the metadata sidecar of an epoch store.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the store without extension.
+    metadata : dict or None
+        The metadata stored next to the data.
+    """
+    with open(store_path + METADATA_FILE_EXTENSION, 'wb') as file:
+        pickle.dump(metadata or {}, file)
+
+
+def load_epoch_store(store_path, mmap_mode='c'):
+    """
+    Open an epoch store.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the store without extension.
+    mmap_mode : {None, 'r', 'r+', 'c'}
+        The memory-map mode of the data block (see numpy.load). With the default 'c' the data are read lazily
+        from disk and in-place changes stay in memory; None loads the whole block into memory.
+
+    Returns
+    -------
+    tuple
+        The epoch data and the metadata dictionary.
+    """
+    data = np.load(store_path + DATA_FILE_EXTENSION, mmap_mode=mmap_mode)
+    with open(store_path + METADATA_FILE_EXTENSION, 'rb') as file:
+        metadata = pickle.load(file)
+    return data, metadata
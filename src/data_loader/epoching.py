@@ -0,0 +1,65 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def nearest_sample_index(times, query_times):
+    """
+    Find the index of the closest sample for every query time.
+
+    This is the batched equivalent of ``np.argmin(np.abs(times - t))`` for a monotonic time vector: a single
+    binary search locates all query times and ties go to the earlier sample.
+
+    Parameters
+    ----------
+    times : numpy.ndarray
+        The monotonically increasing sample times, with shape (n_samples,).
+    query_times : array_like
+        The times to locate.
+
+    Returns
+    -------
+    numpy.ndarray
+        The sample indices, with the shape of query_times.
+    """
+    times = np.asarray(times)
+    query_times = np.asarray(query_times, dtype=float)
+
+    right = np.clip(np.searchsorted(times, query_times), 1, len(times) - 1)
+    left = right - 1
+    use_left = np.abs(query_times - times[left]) <= np.abs(times[right] - query_times)
+    return np.where(use_left, left, right)
+
+
+def extract_epochs(data, starts, epoch_length, copy=True):
+    """
+    Cut fixed-length epochs out of continuous data.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The continuous data, with shape (n_channels, n_samples).
+    starts : array_like
+        The first sample of each epoch.
+    epoch_length : int
+        The number of samples in each epoch.
+    copy : bool
+        If True, the epochs are gathered into a new array. If False and the epochs are evenly spaced and do not
+        overlap, a read-only strided view of data is returned instead; otherwise the epochs are copied.
+
+    Returns
+    -------
+    numpy.ndarray
+        The epochs, with shape (n_epochs, n_channels, epoch_length).
+    """
+    starts = np.asarray(starts, dtype=int)
+    if len(starts) > 0 and (starts.min() < 0 or starts.max() + epoch_length > data.shape[-1]):
+        raise ValueError("The epochs exceed the boundaries of the continuous data")
+
+    windows = sliding_window_view(data, epoch_length, axis=-1)
+    if not copy and len(starts) > 1:
+        steps = np.diff(starts)
+        if np.all(steps == steps[0]) and steps[0] >= epoch_length:
+            return windows[:, starts[0]:starts[-1] + 1:steps[0]].swapaxes(0, 1)
+
+    # A single gather along the window axis allocates the C-contiguous (n_epochs, n_channels, epoch_length) array
+    return windows.swapaxes(0, 1)[starts]
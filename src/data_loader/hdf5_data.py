@@ -0,0 +1,116 @@
+import numpy as np
+import h5py
+
+
+class HDF5EEGData:
+    """
+    Lazy, array-like view of the EEG data block of an HDF5 file.
+
+    The file stores the epochs as (trials, ..., times, channels) with optional singleton axes. This class exposes
+    them as a (trials, channels, times) array and reads only the requested trial/channel/time slices from disk.
+    Index arrays are applied independently on each axis, as in h5py. Outside a ``with`` block the file is opened for each read; inside it, a single handle is kept open.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the HDF5 file.
+    dataset_name : str
+        The path of the EEG data block inside the file.
+    """
+
+    def __init__(self, file_path, dataset_name):
+        self.file_path = file_path
+        self.dataset_name = dataset_name
+        self._file = None
+
+        with h5py.File(file_path, 'r') as file:
+            dataset = file[dataset_name]
+            self._file_shape = dataset.shape
+            self.dtype = dataset.dtype
+        # Axes of the file kept after squeezing, in (trials, times, channels) order
+        self._file_axes = [axis for axis, size in enumerate(self._file_shape) if size != 1]
+        if len(self._file_axes) != 3:
+            raise ValueError(f"Expected trials, times and channels in {dataset_name}, got shape {self._file_shape}")
+        trials, times, channels = (self._file_shape[axis] for axis in self._file_axes)
+        self.shape = (trials, channels, times)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def itemsize(self):
+        return np.dtype(self.dtype).itemsize
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self._file is None:
+            self._file = h5py.File(self.file_path, 'r')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(item is Ellipsis for item in key):
+            position = key.index(Ellipsis)
+            key = key[:position] + (slice(None),) * (self.ndim - len(key) + 1) + key[position + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        trial_key, channel_key, time_key = key
+
+        # h5py reads slices and integers; index arrays are read as their bounding slice and taken in memory
+        file_key = [0] * len(self._file_shape)
+        memory_index = []
+        for axis, item in zip(self._file_axes, (trial_key, time_key, channel_key)):
+            size = self._file_shape[axis]
+            if isinstance(item, (int, np.integer)):
+                file_key[axis] = range(size)[item]
+            elif isinstance(item, slice):
+                file_key[axis] = item
+                memory_index.append(None)
+            else:
+                index = np.arange(size)[item]
+                start = int(index.min()) if index.size > 0 else 0
+                stop = int(index.max()) + 1 if index.size > 0 else 0
+                file_key[axis] = slice(start, stop)
+                memory_index.append(index - start)
+
+        if self._file is None:
+            with h5py.File(self.file_path, 'r') as file:
+                data = file[self.dataset_name][tuple(file_key)]
+        else:
+            data = self._file[self.dataset_name][tuple(file_key)]
+
+        for axis, index in enumerate(memory_index):
+            if index is not None:
+                data = np.take(data, index, axis=axis)
+
+        # Move channels before times when both axes are kept
+        if not isinstance(time_key, (int, np.integer)) and not isinstance(channel_key, (int, np.integer)):
+            data = np.swapaxes(data, -1, -2)
+        return np.ascontiguousarray(data) if np.ndim(data) > 0 else data
@@ -1,13 +1,12 @@
 import os
-import pickle
 
 import numpy as np
-import mne
 from scipy import signal
 from tqdm import tqdm
-from scipy.signal import detrend
-from scipy.signal import butter, filtfilt
-from scipy.signal import resample_poly, butter, filtfilt
+from scipy.signal import resample_poly
+from src.data_loader.epoch_store import epoch_store_exists, save_epoch_store, load_epoch_store
+from src.data_preprocess.preprocessing_plan import PreprocessingPlan
+from src.data_preprocess.filter_bank import FilterBank
 
 
 
@@ -68,24 +67,46 @@ class DataPreprocessor:
             print(
                 f"Subject {patient_id} from {len(eeg_dataset.all_patient_data.items())}: {patient_dataset.file_name.split('.')[0]} Preprocess Data")
 
-            preprocessed_data_path = self.paths.raw_dataset_path + patient_dataset.file_name.split('.')[0] + "_preprocessed.pkl"
-            if os.path.exists(preprocessed_data_path) and self.settings.load_preprocessed_data is True:
-                with open(preprocessed_data_path, 'rb') as file:
-                    preprocessed_dataset = pickle.load(file)
+            preprocessed_data_path = self.paths.raw_dataset_path + patient_dataset.file_name.split('.')[0] + "_preprocessed"
+            if epoch_store_exists(preprocessed_data_path) and self.settings.load_preprocessed_data is True:
+                preprocessed_dataset, _ = load_epoch_store(preprocessed_data_path)
             else:
                 preprocessed_dataset = self.apply_preprocessing(patient_dataset.data, **preprocessing_configs)
                 if self.settings.save_preprocessed_data is True:
-                    with open(preprocessed_data_path, 'wb') as file:
-                        pickle.dump(preprocessed_dataset, file)
+                    save_epoch_store(preprocessed_data_path, preprocessed_dataset,
+                                     metadata={'preprocessing_configs': preprocessing_configs})
+                    # Reopen the saved data memory-mapped to release the in-memory copy
+                    preprocessed_dataset, _ = load_epoch_store(preprocessed_data_path)
 
             eeg_dataset.all_patient_data[patient_id].data = preprocessed_dataset
 
         return eeg_dataset
 
+    def compile_plan(self, preprocessing_configs, dtype=None):
+        """
+        Build the preprocessing plan of the current patient (see PreprocessingPlan).
+
+        Parameters
+        ----------
+        preprocessing_configs : dict
+            A dictionary containing preprocessing steps and their parameters.
+        dtype : numpy.dtype or None
+            The type of the preprocessed data; None keeps the type of floating point data.
+
+        Returns
+        -------
+        PreprocessingPlan
+            The validated and compiled preprocessing steps.
+        """
+        return PreprocessingPlan(preprocessing_configs, time=self.time, fs=self.fs, dtype=dtype)
+
     def apply_preprocessing(self, data: np.ndarray, **kwargs) -> np.ndarray:
         """
         Apply a series of preprocessing steps to the EEG data based on provided keyword arguments.
 
+        The steps are compiled once into a PreprocessingPlan and run in place on chunks of trials of a single
+        output array of the type of the data. Without steps, the data are returned unchanged.
+
         Parameters
         ----------
         data : numpy.ndarray
@@ -98,18 +119,7 @@ class DataPreprocessor:
         numpy.ndarray
             Preprocessed EEG data.
         """
-        for step, params in kwargs.items():
-            if step == 'remove_baseline':
-                data = self.remove_baseline(data, **params)
-            elif step == 'low_pass_filter':
-                data = self.low_pass_filter(data, **params)
-            elif step == 'detrend_eeg':
-                data = self.detrend_eeg(data, **params)
-            elif step == 'common_average_referencing':
-                data = self.common_average_referencing(data, **params)
-            # Add more preprocessing steps as needed
-
-        return data
+        return self.compile_plan(kwargs).apply(data)
 
     def remove_baseline(self, data, baseline_t_min=-300, baseline_t_max=0, normalize=True):
         """
@@ -126,65 +136,49 @@ class DataPreprocessor:
             The starting time (in ms) of the baseline period (default is -300).
         baseline_t_max : int, optional
             The ending time (in ms) of the baseline period (default is 0).
+        normalize : bool, optional
+            If True, the data are divided by the 99th percentile of the absolute baseline (default is True).
 
         Returns
         -------
         numpy.ndarray
             The EEG data with the baseline removed.
         """
-        # Determine start and end indices for the baseline time window
-        idx_start = np.argmin(np.abs(self.time - baseline_t_min))
-        idx_end = np.argmin(np.abs(self.time - baseline_t_max))
-
-        if (idx_end - idx_start) > 5:
-            # Calculate the baseline mean values for each trial and channel
-            baseline_means = np.mean(data[:, :, idx_start:idx_end], axis=2, keepdims=True)
+        return self.apply_preprocessing(data, remove_baseline={'baseline_t_min': baseline_t_min,
+                                                               'baseline_t_max': baseline_t_max,
+                                                               'normalize': normalize})
 
-            # Subtract the baseline mean from all time points for each trial and channel
-            eeg_data_baseline_removed = data - baseline_means
-
-            if normalize is True:
-                maximum = np.quantile(np.abs(eeg_data_baseline_removed[:, :, idx_start:idx_end]),
-                                      0.99, axis=2, keepdims=True)
-                eeg_data_baseline_removed = eeg_data_baseline_removed / maximum
-
-        return eeg_data_baseline_removed
-
-    def detrend_eeg(self, data):
+    def detrend_eeg(self, data, order=1):
         """
         Detrend the EEG data by removing the linear trend from each trial and channel.
 
         This method applies a linear detrend operation, which can be useful for
-        reducing low-frequency drifts in the EEG data.
+        reducing low-frequency drifts in the EEG data. The trend of all the trials and channels is fitted at once
+        by least squares against a precomputed design matrix.
 
         Parameters
         ----------
         data : numpy.ndarray
             The EEG data from which to remove the linear trend.
+        order : int, optional
+            The order of the polynomial trend (default is 1, linear).
 
         Returns
         -------
         numpy.ndarray
             The EEG data with the linear trend removed.
         """
-        # Apply linear detrend on each trial and channel
-        eeg_data_detrended = np.apply_along_axis(detrend, axis=2, arr=data)
-
-        return eeg_data_detrended
+        return self.apply_preprocessing(data, detrend_eeg={'order': order})
 
     def resample(self, single_patient_data, f_resample, anti_alias_filter=False):
         # Compute resampling factor
         # Compute resampling factor
         resample_factor = single_patient_data.fs // f_resample
 
-        # Design a low-pass anti-aliasing filter
-        nyquist_freq = 0.5 * single_patient_data.fs
-        cutoff_freq = 0.5 * f_resample
-        b, a = butter(4, cutoff_freq / nyquist_freq, btype='low')
-
         if anti_alias_filter is True:
-            # Apply the anti-aliasing filter to EEG signal
-            filtered_signal = filtfilt(b, a, single_patient_data.data, axis=-1)
+            # Apply a low-pass anti-aliasing filter to EEG signal
+            filtered_signal = FilterBank().filter(single_patient_data.data, 'lowpass', 0.5 * f_resample,
+                                                  single_patient_data.fs, order=4)
         else:
             filtered_signal = single_patient_data.data
 
@@ -213,74 +207,64 @@ class DataPreprocessor:
         numpy.ndarray
             The EEG data after applying common average referencing.
         """
-        # Compute the mean signal across all electrodes for each time point
-        mean_signal = np.mean(data, axis=1, keepdims=True)
-        # Subtract the mean signal from each electrode's signal
-        data = data - mean_signal
-
-        return data
+        return self.apply_preprocessing(data, common_average_referencing={})
 
-    def filter_data(self, low_cutoff=0.1, high_cutoff=300):
+    def filter_data(self, data, low_cutoff=0.1, high_cutoff=300, order=4):
         """
         Filter the EEG data using a bandpass filter.
 
-        This method applies a Butterworth bandpass filter to the data.
+        This method applies a zero-phase Butterworth bandpass filter to the data.
 
         Parameters
         ----------
+        data : numpy.ndarray
+            The EEG data to filter.
         low_cutoff : float, optional
             The low-frequency cutoff for the filter (default is 0.1 Hz).
         high_cutoff : float, optional
             The high-frequency cutoff for the filter (default is 300 Hz).
+        order : int, optional
+            The order of the filter (default is 4).
 
         Returns
         -------
         numpy.ndarray
             The filtered EEG data.
         """
-        # Compute filter coefficients
-        nyquist_freq = self.fs / 2
-        b, a = signal.butter(4, [low_cutoff / nyquist_freq, high_cutoff / nyquist_freq], btype='bandpass')
+        return self.apply_preprocessing(data, band_pass_filter={'low_cutoff': low_cutoff,
+                                                                'high_cutoff': high_cutoff,
+                                                                'order': order})
 
-        # Filter iEEG data
-        filtered_data = signal.filtfilt(b, a, self.data, axis=2)
+    def low_pass_filter(self, data, cutoff=10, order=5):
+        return self.apply_preprocessing(data, low_pass_filter={'cutoff': cutoff, 'order': order})
 
-        return filtered_data
+    def remove_line_noise(self, data, line_frequency=60, n_harmonics=None, quality=30):
+        """
+        Remove the line noise and its harmonics from the EEG data.
 
-    def low_pass_filter(self, data, cutoff=10, order=5):
-        # Compute filter coefficients
-        nyq = 0.5 * self.fs  # Nyquist Frequency
-        normal_cutoff = cutoff / nyq
-        b, a = butter(N=order, Wn=normal_cutoff, btype='low', analog=False)
-
-        # Apply the filter to the signal
-        filtered_signal = filtfilt(b, a, data)
-
-        return filtered_signal
-
-    def remove_line_noise(self,
-                          freqs_to_remove=[60],
-                          filter_length='auto',
-                          phase='zero',
-                          method='fir',
-                          trans_bandwidth=1.0,
-                          mt_bandwidth=None):
-        # Reshape data to 2D array of shape (n_channels, n_samples)
-        data_mne = self.array_to_mne_raw()
-
-        # Apply the notch filter
-        notch_filtered_epochs = data_mne.notch_filter(freqs_to_remove,
-                                                      filter_length=filter_length,
-                                                      phase=phase,
-                                                      method=method,
-                                                      trans_bandwidth=trans_bandwidth,
-                                                      mt_bandwidth=mt_bandwidth)
-
-        filtered_data = notch_filtered_epochs.get_data()
-
-        self.data = filtered_data.reshape(self.n_channels, self.n_trials, self.n_samples).transpose(1, 0, 2)
-        self.dataset.data = self.data
-        return self.data
+        A cascade of zero-phase IIR notch filters is applied to all the trials and channels, without converting the
+        data to MNE objects.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The EEG data to filter.
+        line_frequency : float, optional
+            The frequency of the power line in Hz (default is 60).
+        n_harmonics : int or None, optional
+            The number of harmonics removed with the line frequency; None removes all the harmonics below the
+            Nyquist frequency (default is None).
+        quality : float, optional
+            The quality factor of the notches (default is 30).
+
+        Returns
+        -------
+        numpy.ndarray
+            The filtered EEG data.
+        """
+        return self.apply_preprocessing(data, remove_line_noise={'line_frequency': line_frequency,
+                                                                 'n_harmonics': n_harmonics,
+                                                                 'quality': quality})
 
     def baseline_removal(self, method='zero_mean', window_size=100, min_time=0, max_time=None):
         """
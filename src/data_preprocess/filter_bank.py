@@ -0,0 +1,198 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, iirnotch, tf2sos, sosfiltfilt
+
+
+@lru_cache(maxsize=128)
+def design_sos(btype, order, cutoff, fs):
+    """
+    Design a Butterworth filter as second-order sections.
+
+    The designs are cached by (btype, order, cutoff, fs), so the filters of the steps, patients and chunks that
+    share a specification are designed once.
+
+    Parameters
+    ----------
+    btype : {'lowpass', 'highpass', 'bandpass', 'bandstop'}
+        The type of filter.
+    order : int
+        The order of the filter.
+    cutoff : float or tuple of float
+        The cutoff frequency in Hz, or the (low, high) cutoff frequencies of band filters.
+    fs : float
+        The sampling frequency in Hz.
+
+    Returns
+    -------
+    numpy.ndarray
+        The second-order sections, with shape (n_sections, 6). The array is shared and must not be modified.
+    """
+    return butter(order, cutoff, btype=btype, fs=fs, output='sos')
+
+
+@lru_cache(maxsize=128)
+def design_notch_sos(freqs, quality, fs):
+    """
+    Design a cascade of IIR notch filters as second-order sections.
+
+    The designs are cached by (freqs, quality, fs).
+
+    Parameters
+    ----------
+    freqs : tuple of float
+        The frequencies to remove in Hz, e.g. the line frequency and its harmonics.
+    quality : float
+        The quality factor of the notches (center frequency / bandwidth).
+    fs : float
+        The sampling frequency in Hz.
+
+    Returns
+    -------
+    numpy.ndarray
+        The second-order sections of the cascade, one per frequency, with shape (n_freqs, 6).
+    """
+    return np.concatenate([tf2sos(*iirnotch(freq, quality, fs=fs)) for freq in freqs])
+
+
+def line_noise_frequencies(line_frequency, n_harmonics, fs):
+    """
+    Get the line frequency and its harmonics below the Nyquist frequency.
+
+    Parameters
+    ----------
+    line_frequency : float
+        The frequency of the power line in Hz.
+    n_harmonics : int or None
+        The number of harmonics kept after the line frequency; None keeps all the harmonics below the Nyquist
+        frequency.
+    fs : float
+        The sampling frequency in Hz.
+
+    Returns
+    -------
+    tuple of float
+        The frequencies to remove in Hz.
+    """
+    freqs = np.arange(1, int((0.5 * fs - 1) // line_frequency) + 1) * float(line_frequency)
+    if n_harmonics is not None:
+        freqs = freqs[:n_harmonics + 1]
+    if len(freqs) == 0:
+        raise ValueError(f"The line frequency {line_frequency} Hz is above the Nyquist frequency")
+    return tuple(freqs)
+
+
+class FilterBank:
+    """
+    Zero-phase Butterworth filtering in second-order sections, with the rows of the data split between threads.
+
+    sosfiltfilt is numerically stable at high orders and low cutoffs, unlike filtfilt on transfer function
+    coefficients, and SciPy releases the GIL while filtering, so the threads run in parallel. The data are
+    filtered as (trials * channels, samples) rows, so that even a chunk of a few trials is split between all the
+    threads, and the threads are kept in one executor for all the calls.
+
+    Parameters
+    ----------
+    num_threads : int or None
+        The number of threads; None uses all the available cores.
+    """
+
+    def __init__(self, num_threads=None):
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def close(self):
+        """
+        Stop the threads of the filter bank; they are started again by the next call.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @staticmethod
+    def design(btype, cutoff, fs, order=4):
+        """
+        Get the cached second-order sections of a filter (see design_sos).
+        """
+        cutoff = tuple(float(value) for value in cutoff) if np.ndim(cutoff) > 0 else float(cutoff)
+        return design_sos(btype, int(order), cutoff, float(fs))
+
+    def filter(self, data, btype, cutoff, fs, order=4, out=None):
+        """
+        Filter data along their last axis.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The data, e.g. with shape (n_trials, n_channels, n_samples) or (n_channels, n_samples). The first axis
+            is split between the threads.
+        btype : {'lowpass', 'highpass', 'bandpass', 'bandstop'}
+            The type of filter.
+        cutoff : float or sequence of float
+            The cutoff frequency in Hz, or the (low, high) cutoff frequencies of band filters.
+        fs : float
+            The sampling frequency in Hz.
+        order : int
+            The order of the filter.
+        out : numpy.ndarray or None
+            The output array, which may be data itself. None allocates an array of the type of data.
+
+        Returns
+        -------
+        numpy.ndarray
+            The filtered data.
+        """
+        return self.apply_sos(data, self.design(btype, cutoff, fs, order=order), out=out)
+
+    def apply_sos(self, data, sos, out=None):
+        """
+        Apply second-order sections forward and backward along the last axis of data.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The data; all the rows along the last axis (e.g. trials and channels) are split between the threads.
+        sos : numpy.ndarray
+            The second-order sections, e.g. from design_sos or design_notch_sos.
+        out : numpy.ndarray or None
+            The output array, which may be data itself. None allocates an array of the type of data.
+
+        Returns
+        -------
+        numpy.ndarray
+            The filtered data.
+        """
+        if out is None:
+            out = np.empty_like(data)
+
+        n_rows = int(np.prod(data.shape[:-1]))
+        num_threads = min(self.num_threads, n_rows)
+        if num_threads <= 1:
+            out[...] = sosfiltfilt(sos, data, axis=-1)
+            return out
+
+        # Filter (rows, samples) views of the data; the rows are written back to out if it cannot be viewed so
+        data_rows = data.reshape(n_rows, data.shape[-1])
+        out_rows = out.reshape(n_rows, out.shape[-1]) if out.flags.c_contiguous else np.empty_like(data_rows)
+
+        def filter_rows(rows):
+            out_rows[rows] = sosfiltfilt(sos, data_rows[rows], axis=-1)
+
+        bounds = np.linspace(0, n_rows, num_threads + 1).astype(int)
+        list(self.executor.map(filter_rows, [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]))
+        if not out.flags.c_contiguous:
+            out[...] = out_rows.reshape(out.shape)
+        return out
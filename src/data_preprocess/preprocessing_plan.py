@@ -0,0 +1,145 @@
+import numpy as np
+
+from src.data_loader.epoching import nearest_sample_index
+from src.data_preprocess.filter_bank import FilterBank, design_notch_sos, line_noise_frequencies
+
+# Size of the trial chunks processed by all the steps while they stay in the CPU cache
+DEFAULT_CHUNK_BYTES = 4 * 1024 ** 2
+
+
+class PreprocessingPlan:
+    """
+    Preprocessing steps compiled once and applied in place on chunks of trials.
+
+    The steps of preprocessing_configs are validated and their constants (sample indices, filter coefficients, ...)
+    are computed when the plan is built. apply then copies a chunk of trials into a floating-point output buffer and
+    runs all the steps in place on that chunk, so the data are read once, no step allocates a full-size array, and
+    each chunk stays in the cache between the steps. All the steps work on each trial independently. A plan
+    without steps returns the data unchanged, so lazy or memory-mapped inputs are not loaded.
+
+    Parameters
+    ----------
+    preprocessing_configs : dict
+        The preprocessing steps, in order, with their parameters, e.g.
+        {'remove_baseline': {'baseline_t_min': -300, 'baseline_t_max': 0}, 'common_average_referencing': {}}.
+    time : numpy.ndarray
+        The time of the samples in ms.
+    fs : float
+        The sampling frequency in Hz.
+    chunk_bytes : int
+        The size of the trial chunks in bytes.
+    num_threads : int or None
+        The number of threads of the filters (see FilterBank); None uses all the available cores.
+    dtype : numpy.dtype or None
+        The type of the preprocessed data, e.g. numpy.float32 to halve their size. None keeps the type of floating
+        point data and converts integer data to floating point.
+    """
+
+    def __init__(self, preprocessing_configs, time, fs, chunk_bytes=DEFAULT_CHUNK_BYTES, num_threads=None,
+                 dtype=None):
+        self.time = np.asarray(time)
+        self.fs = fs
+        self.chunk_bytes = chunk_bytes
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.filter_bank = FilterBank(num_threads=num_threads)
+        self.steps = []
+        for step, params in preprocessing_configs.items():
+            compile_step = getattr(self, f'_compile_{step}', None)
+            if compile_step is None:
+                raise ValueError(f"Unknown preprocessing step '{step}'")
+            try:
+                self.steps.append(compile_step(**(params or {})))
+            except TypeError as error:
+                raise ValueError(f"Invalid parameters for the preprocessing step '{step}': {error}") from error
+
+    def apply(self, data, out=None):
+        """
+        Preprocess trials.
+
+        Parameters
+        ----------
+        data : array_like
+            The EEG data, with shape (n_trials, n_channels, n_samples). Any array supporting slicing of the trials
+            works, e.g. a memory-mapped epoch store or an HDF5EEGData.
+        out : numpy.ndarray or None
+            The output array, e.g. a memory-mapped epoch store. None allocates it, with the type of the plan.
+
+        Returns
+        -------
+        numpy.ndarray
+            The preprocessed data, or data itself if the plan has no steps and out is None.
+        """
+        if out is None:
+            if len(self.steps) == 0:
+                return data
+            out = np.empty(data.shape, dtype=self.dtype or np.promote_types(data.dtype, np.float32))
+        n_trials = data.shape[0]
+        trial_bytes = max(1, int(np.prod(data.shape[1:])) * out.dtype.itemsize)
+        chunk_size = max(1, self.chunk_bytes // trial_bytes)
+
+        for start in range(0, n_trials, chunk_size):
+            chunk = out[start:start + chunk_size]
+            chunk[...] = data[start:start + chunk_size]
+            for step in self.steps:
+                step(chunk)
+        return out
+
+    def _compile_remove_baseline(self, baseline_t_min=-300, baseline_t_max=0, normalize=True):
+        idx_start, idx_end = nearest_sample_index(self.time, [baseline_t_min, baseline_t_max])
+        if idx_end - idx_start <= 5:
+            raise ValueError(f"The baseline window {baseline_t_min}-{baseline_t_max} ms has less than 6 samples")
+
+        def remove_baseline(chunk):
+            # Subtract the mean of the baseline window from each trial and channel
+            chunk -= np.mean(chunk[:, :, idx_start:idx_end], axis=2, keepdims=True)
+            if normalize is True:
+                chunk /= np.quantile(np.abs(chunk[:, :, idx_start:idx_end]), 0.99, axis=2, keepdims=True)
+
+        return remove_baseline
+
+    def _compile_common_average_referencing(self):
+        def common_average_referencing(chunk):
+            chunk -= np.mean(chunk, axis=1, keepdims=True)
+
+        return common_average_referencing
+
+    def _compile_detrend_eeg(self, order=1):
+        # Least-squares fit of a polynomial of the (scaled) sample index: the trend of all the trials and channels
+        # is chunk @ projection @ design.T
+        n_samples = len(self.time)
+        design = np.vander(np.linspace(-1, 1, n_samples), order + 1)
+        projection = np.linalg.pinv(design).T
+
+        def detrend_eeg(chunk):
+            # The matrices are used in the type of the chunk so that the products do not upcast it
+            chunk_projection = projection.astype(chunk.dtype, copy=False)
+            chunk -= (chunk @ chunk_projection) @ design.T.astype(chunk.dtype, copy=False)
+
+        return detrend_eeg
+
+    def _compile_filter(self, btype, cutoff, order):
+        # Design the filter now so that invalid cutoffs are reported when the plan is built
+        self.filter_bank.design(btype, cutoff, self.fs, order=order)
+
+        def filter_chunk(chunk):
+            self.filter_bank.filter(chunk, btype, cutoff, self.fs, order=order, out=chunk)
+
+        return filter_chunk
+
+    def _compile_low_pass_filter(self, cutoff=10, order=5):
+        return self._compile_filter('lowpass', cutoff, order)
+
+    def _compile_high_pass_filter(self, cutoff=0.1, order=4):
+        return self._compile_filter('highpass', cutoff, order)
+
+    def _compile_band_pass_filter(self, low_cutoff=0.1, high_cutoff=300, order=4):
+        return self._compile_filter('bandpass', (low_cutoff, high_cutoff), order)
+
+    def _compile_remove_line_noise(self, line_frequency=60, n_harmonics=None, quality=30):
+        freqs = line_noise_frequencies(line_frequency, n_harmonics, self.fs)
+        sos = design_notch_sos(freqs, float(quality), float(self.fs))
+
+        def remove_line_noise(chunk):
+            self.filter_bank.apply_sos(chunk, sos, out=chunk)
+
+        return remove_line_noise
@@ -0,0 +1,227 @@
+import numpy as np
+from scipy.signal import sosfilt, sosfilt_zi, sosfiltfilt
+
+from src.data_loader.epoch_store import create_epoch_store, save_epoch_metadata, load_epoch_store
+from src.data_preprocess.filter_bank import FilterBank, design_notch_sos, line_noise_frequencies
+from src.data_preprocess.preprocessing_plan import DEFAULT_CHUNK_BYTES
+
+# Length of the blocks of continuous data read at once
+DEFAULT_BLOCK_SECONDS = 60
+
+
+def settling_samples(sos, tol=1e-6, max_samples=2 ** 24):
+    """
+    Get the number of samples after which the impulse response of a filter has decayed.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        The second-order sections of the filter.
+    tol : float
+        The amplitude, relative to the peak of the impulse response, below which the response is settled.
+    max_samples : int
+        The maximum length of the impulse response that is computed.
+
+    Returns
+    -------
+    int
+        The index of the last sample of the impulse response above tol, plus one.
+    """
+    n_samples = 1024
+    while True:
+        impulse = np.zeros(n_samples)
+        impulse[0] = 1
+        response = np.abs(sosfilt(sos, impulse))
+        settled = int(np.flatnonzero(response > tol * response.max())[-1]) + 1
+        if settled < n_samples // 2 or n_samples >= max_samples:
+            return settled
+        n_samples *= 2
+
+
+class StreamingPreprocessor:
+    """
+    Preprocess a continuous recording block by block and write its epochs straight into an epoch store.
+
+    Only one block of the recording is in memory at a time, so recordings that do not fit in RAM can be read from
+    a memory-mapped array or an HDF5 dataset. The filters are cascaded into a single set of second-order sections:
+
+    - with phase='causal', the state of the filter is carried from one block to the next, which gives exactly the
+      output of filtering the whole recording at once;
+    - with phase='zero', each block is filtered forward and backward with `padding` samples of context on both
+      sides (overlap-save), which matches filtering the whole recording up to the settling tolerance.
+
+    The normalization of load_single_patient_data (division of each channel by the 99th percentile of its absolute
+    value and removal of its mean) needs statistics of the whole recording. They are accumulated while the blocks
+    are read, keeping only the largest absolute values needed for the exact percentile, and the epochs are
+    normalized in place once all the blocks have been processed.
+
+    Parameters
+    ----------
+    filter_configs : dict
+        The filters, in order, with their parameters, e.g.
+        {'band_pass_filter': {'low_cutoff': 1, 'high_cutoff': 60}, 'remove_line_noise': {}}. The steps and their
+        parameters are those of PreprocessingPlan.
+    fs : float
+        The sampling frequency in Hz.
+    phase : {'zero', 'causal'}
+        The phase of the filters.
+    normalize : bool
+        If True, each channel is divided by the quantile of its absolute value and its mean is removed.
+    quantile : float
+        The quantile of the absolute value used for the normalization.
+    block_seconds : float
+        The length of the blocks in seconds.
+    padding : int or None
+        The number of samples of context read on each side of the blocks for zero-phase filtering; None uses the
+        settling time of the filters.
+    tol : float
+        The settling tolerance of the filters used when padding is None (see settling_samples).
+    """
+
+    def __init__(self, filter_configs, fs, phase='zero', normalize=True, quantile=0.99,
+                 block_seconds=DEFAULT_BLOCK_SECONDS, padding=None, tol=1e-8):
+        if phase not in ['zero', 'causal']:
+            raise ValueError("phase should be 'zero' or 'causal'")
+        if not 0 <= quantile <= 1:
+            raise ValueError("quantile should be between 0 and 1")
+        self.fs = fs
+        self.phase = phase
+        self.normalize = normalize
+        self.quantile = quantile
+        self.block_size = max(1, int(round(block_seconds * fs)))
+
+        sections = []
+        for step, params in (filter_configs or {}).items():
+            compile_step = getattr(self, f'_compile_{step}', None)
+            if compile_step is None:
+                raise ValueError(f"Unknown continuous preprocessing step '{step}'")
+            try:
+                sections.append(compile_step(**(params or {})))
+            except TypeError as error:
+                raise ValueError(f"Invalid parameters for the preprocessing step '{step}': {error}") from error
+        self.sos = np.concatenate(sections) if len(sections) > 0 else None
+
+        if self.sos is None or phase == 'causal':
+            self.padding = 0
+        else:
+            self.padding = settling_samples(self.sos, tol=tol) if padding is None else int(padding)
+
+    def _compile_low_pass_filter(self, cutoff=10, order=5):
+        return FilterBank.design('lowpass', cutoff, self.fs, order=order)
+
+    def _compile_high_pass_filter(self, cutoff=0.1, order=4):
+        return FilterBank.design('highpass', cutoff, self.fs, order=order)
+
+    def _compile_band_pass_filter(self, low_cutoff=0.1, high_cutoff=300, order=4):
+        return FilterBank.design('bandpass', (low_cutoff, high_cutoff), self.fs, order=order)
+
+    def _compile_remove_line_noise(self, line_frequency=60, n_harmonics=None, quality=30):
+        freqs = line_noise_frequencies(line_frequency, n_harmonics, self.fs)
+        return design_notch_sos(freqs, float(quality), float(self.fs))
+
+    def process(self, source, starts, epoch_length, store_path, metadata=None, channels=None, time_axis=-1,
+                dtype=np.float32):
+        """
+        Preprocess a continuous recording and write its epochs to an epoch store.
+
+        Parameters
+        ----------
+        source : array_like
+            The continuous recording, with shape (n_channels, n_samples), or (n_samples, n_channels) with
+            time_axis=0. Any array supporting slicing of the samples works, e.g. a memory-mapped .npy file or an
+            h5py dataset.
+        starts : array_like
+            The first sample of each epoch.
+        epoch_length : int
+            The number of samples in each epoch.
+        store_path : str
+            The path of the epoch store without extension.
+        metadata : dict or None
+            The metadata stored next to the epochs.
+        channels : array_like or None
+            The indices of the channels kept; None keeps all the channels.
+        time_axis : {-1, 1, 0}
+            The axis of the samples in source.
+        dtype : numpy.dtype
+            The type of the stored epochs.
+
+        Returns
+        -------
+        numpy.ndarray
+            The epochs, with shape (n_epochs, n_channels, epoch_length), memory-mapped from the store.
+        """
+        if time_axis not in [-1, 0, 1]:
+            raise ValueError("time_axis should be 0 or -1")
+        time_axis = 1 if time_axis == -1 else time_axis
+        n_samples = source.shape[time_axis]
+        n_channels = source.shape[1 - time_axis] if channels is None else len(channels)
+
+        starts = np.asarray(starts, dtype=int)
+        stops = starts + epoch_length
+        if len(starts) > 0 and (starts.min() < 0 or stops.max() > n_samples):
+            raise ValueError("The epochs exceed the boundaries of the continuous data")
+
+        def read(start, stop):
+            block = source[:, start:stop] if time_axis == 1 else np.transpose(source[start:stop])
+            if channels is not None:
+                block = np.take(block, channels, axis=0)
+            return np.asarray(block, dtype=np.float64)
+
+        epochs = create_epoch_store(store_path, (len(starts), n_channels, epoch_length), dtype=dtype)
+
+        # Statistics of the whole recording for the normalization. The linear interpolation of the quantile only
+        # needs the sorted absolute values from rank floor(quantile * (n_samples - 1)), i.e. the largest ones.
+        rank = int(np.floor(self.quantile * (n_samples - 1)))
+        n_largest = n_samples - rank
+        largest = np.empty((n_channels, 0))
+        total = np.zeros(n_channels)
+
+        zi = None
+        for block_start in range(0, n_samples, self.block_size):
+            block_stop = min(block_start + self.block_size, n_samples)
+            if self.sos is None:
+                block = read(block_start, block_stop)
+            elif self.phase == 'causal':
+                block = read(block_start, block_stop)
+                if zi is None:
+                    # Start from the steady state of the first sample to avoid an onset transient
+                    zi = sosfilt_zi(self.sos)[:, None, :] * block[None, :, :1]
+                block, zi = sosfilt(self.sos, block, axis=-1, zi=zi)
+            else:
+                read_start = max(0, block_start - self.padding)
+                read_stop = min(n_samples, block_stop + self.padding)
+                block = sosfiltfilt(self.sos, read(read_start, read_stop), axis=-1)
+                block = block[:, block_start - read_start:block_stop - read_start]
+
+            # Copy the part of every epoch overlapping the block
+            overlapping = np.flatnonzero((starts < block_stop) & (stops > block_start))
+            for epoch in overlapping:
+                first = max(starts[epoch], block_start)
+                last = min(stops[epoch], block_stop)
+                epochs[epoch, :, first - starts[epoch]:last - starts[epoch]] = \
+                    block[:, first - block_start:last - block_start]
+
+            if self.normalize:
+                total += block.sum(axis=-1)
+                largest = np.concatenate([largest, np.abs(block)], axis=-1)
+                if largest.shape[-1] > n_largest:
+                    largest = np.partition(largest, largest.shape[-1] - n_largest, axis=-1)[:, -n_largest:]
+
+        if self.normalize and n_samples > 0:
+            largest = np.sort(largest, axis=-1)
+            position = self.quantile * (n_samples - 1) - rank
+            scale = largest[:, 0] + position * (largest[:, min(1, n_largest - 1)] - largest[:, 0])
+            mean = total / n_samples
+
+            # Normalize the stored epochs in place, chunk by chunk
+            epoch_bytes = max(1, n_channels * epoch_length * epochs.dtype.itemsize)
+            chunk_size = max(1, DEFAULT_CHUNK_BYTES // epoch_bytes)
+            for start in range(0, len(starts), chunk_size):
+                chunk = epochs[start:start + chunk_size]
+                chunk -= mean[:, None].astype(epochs.dtype)
+                chunk /= scale[:, None].astype(epochs.dtype)
+
+        epochs.flush()
+        del epochs
+        save_epoch_metadata(store_path, metadata)
+        return load_epoch_store(store_path)[0]
@@ -1,11 +1,10 @@
-from mne.time_frequency import psd_array_multitaper
 from src.utils.spectral_matrix.spectral_features import SpectralMatrixFeatures
+from src.utils.spectral_matrix.multitaper import multitaper_band_power, signal_chunks
+from src.feature_extraction.feature_store import FEATURE_FILE_EXTENSION, save_feature_frame, load_feature_frame
 import pandas as pd
 import logging
 import numpy as np
-import pickle as pkl
 import os
-from pathlib import Path
 
 
 class FeatureExtractor:
@@ -84,15 +83,17 @@ class FeatureExtractor:
 
             # Define the path to save or load feature data
             if self.settings.dataset == 'clear':
-                file_name = f"{patient_id.split('.')[0]}_{self.settings.dataset_task}_features.csv"
+                file_name = f"{patient_id.split('.')[0]}_{self.settings.dataset_task}_features{FEATURE_FILE_EXTENSION}"
             else:
-                file_name = f"{patient_id}_features.csv"
+                file_name = f"{patient_id}_features{FEATURE_FILE_EXTENSION}"
             feature_file = os.path.join(self.paths.feature_path, file_name)
 
             # Check if feature data already exists and should be loaded
             if os.path.exists(feature_file) and self.settings.load_features is True:
                 # Load and store existing feature data
-                self.all_patient_features[patient_id] = self.load_features(feature_file)
+                features_df = self.load_features(feature_file)
+                self.all_patient_features[patient_id] = features_df
+                features_all_blocks[patient_id] = features_df
                 logging.info("Successfully Loaded!")
             else:
                 # Extract features for the current patient dataset
@@ -102,21 +103,22 @@ class FeatureExtractor:
                 self.all_patient_features[patient_id] = features
 
                 logging.info("Successfully Extracted!")
-                features_df = self.feature_dict_to_df(eeg_dataset,
-                                                      feature_dict=features,
-                                                      patient_id=index,
-                                                      patient_file_name=patient_id)
+                features_df, feature_columns = self.feature_dict_to_df(eeg_dataset,
+                                                                       feature_dict=features,
+                                                                       patient_id=index,
+                                                                       patient_file_name=patient_id,
+                                                                       return_feature_columns=True)
 
                 # Save the features to a file for future use
                 if self.settings.save_features is True:
-                    features_df.to_csv(feature_file)
-                    # self.save_features(features, feature_file)
+                    self.save_features(features_df, feature_file, feature_columns)
 
                 features_all_blocks[patient_id] = features_df
 
         return features_all_blocks
 
-    def feature_dict_to_df(self, eeg_dataset, feature_dict, patient_id, patient_file_name):
+    def feature_dict_to_df(self, eeg_dataset, feature_dict, patient_id, patient_file_name,
+                           return_feature_columns=False):
         features_list, features_list_name = self.process_patient_features(patient_file_name, feature_dict,
                                                                           eeg_dataset)
 
@@ -140,6 +142,8 @@ class FeatureExtractor:
         # Concatenate the label DataFrame to the features DataFrame
         features_df = pd.concat([features_df, labels_df], axis=1)
 
+        if return_feature_columns:
+            return features_df, features_list_name
         return features_df
 
     def apply_feature_extraction(self, dataset, **kwargs) -> dict:
@@ -242,62 +246,60 @@ class FeatureExtractor:
             A dictionary containing extracted coherence features.
         """
         eeg_data = dataset.data
-        channel_groups = dataset.channel_group
 
         # Convert time to indices
         start_idx, end_idx = self._time_to_indices(time_start, end_time)
 
-        connectivity_features = {}  # Initialize a dictionary to store coherence features
-
-        for ind in range(eeg_data.shape[0]):  # Loop over EEG data samples
-            # Assume temp is an MNE Epochs object
-            temp = eeg_data[ind]
-            max_ch = min(len(ch_list[0]) for ch_list in channel_groups)
-            Data = np.zeros((max_ch, len(channel_groups), end_idx - start_idx))
-
-            for grp_idx, ch_list in enumerate(channel_groups):  # Loop over channel groups
-                ch_list = np.squeeze(ch_list)
-                for ch_idx in range(max_ch):
-                    if ch_idx < len(ch_list):
-                        ch = ch_list[ch_idx] - 1
-                        eeg_x = temp[ch, start_idx:end_idx]  # Extract the EEG segment
-                        Data[ch_idx, grp_idx, :] = eeg_x - np.mean(eeg_x)  # Subtract mean and assign
-                    else:
-                        # Handle cases where the current channel group has less than max_ch channels
-                        Data[ch_idx, grp_idx, :] = np.nan  # or some other placeholder value
-
-            # Coherence Analysis
-            fmin, fmax = 4, 60  # Define the frequency band of interest
-
-            for method in ['coh']:  # Choose the coherence method (e.g., 'coh', 'imcoh', 'plv', etc.)
-                group_names = [f'group{idx}' for idx in range(Data.shape[1])]
-
-                # Initialize an object for spectral matrix features
-                spectral_features = SpectralMatrixFeatures(dataset)
-
-                # Calculate the spectral matrix and coherence features
-                spectral_features.calculate_matrix(Data, fmin=fmin, fmax=fmax, ch_names=group_names, bandwidth=5,
-                                                   adaptive=True, desired_freqs=[4, 8, 13, 30], verbose=False)
-                coh_matrix, coh_tot, coh_ent, coh_vec = spectral_features.coherency_matrix()
-
-                # Store the coherence features in the connectivity_features dictionary
-                if 'coh_tot_' + method in connectivity_features.keys():
-                    connectivity_features['coh_tot_' + method].append(coh_tot)
-                else:
-                    connectivity_features['coh_tot_' + method] = [coh_tot]
+        # Index tensor (channels x groups) of the first max_ch channels of every group
+        channel_index = self._channel_group_index(dataset.channel_group)
+        group_names = [f'group{idx}' for idx in range(channel_index.shape[1])]
+
+        # Coherence Analysis
+        fmin, fmax = 4, 60  # Define the frequency band of interest
+        method = 'coh'  # Choose the coherence method (e.g., 'coh', 'imcoh', 'plv', etc.)
+
+        coh_tot, coh_vec = [], []
+        bytes_per_trial = 2 * np.dtype(eeg_data.dtype).itemsize * channel_index.size * (end_idx - start_idx)
+        for chunk in signal_chunks(eeg_data.shape[0], bytes_per_trial):
+            # Gather (trials x channels x groups x time) and subtract the mean of every segment
+            data = eeg_data[chunk][:, channel_index, start_idx:end_idx]
+            data = data - np.mean(data, axis=-1, keepdims=True)
+
+            # Calculate the spectral matrix and coherence features of all the trials at once
+            spectral_features = SpectralMatrixFeatures(dataset)
+            spectral_features.calculate_matrix(data, fmin=fmin, fmax=fmax, ch_names=group_names, bandwidth=5,
+                                               adaptive=True, desired_freqs=[4, 8, 13, 30], verbose=False)
+            _, chunk_coh_tot, _, chunk_coh_vec = spectral_features.coherency_matrix()
+            coh_tot.append(chunk_coh_tot)
+            coh_vec.append(chunk_coh_vec)
+
+        # Store the coherence features in the connectivity_features dictionary
+        connectivity_features = {
+            'coh_tot_' + method: np.concatenate(coh_tot, axis=0),
+            'coh_vec_' + method: np.concatenate(coh_vec, axis=0),
+            'coh_' + method + '_freqs': np.array(spectral_features.freqs)
+        }
 
-                if 'coh_vec_' + method in connectivity_features.keys():
-                    connectivity_features['coh_vec_' + method].append(coh_vec)
-                else:
-                    connectivity_features['coh_vec_' + method] = [coh_vec]
+        return connectivity_features
 
-                connectivity_features['coh_' + method + '_freqs'] = spectral_features.freqs
+    def _channel_group_index(self, channel_groups):
+        """
+        Build the index tensor used to gather the channels of every channel group.
 
-        # Stack the coherence features into numpy arrays
-        for method in connectivity_features.keys():
-            connectivity_features[method] = np.stack(connectivity_features[method], axis=0)
+        Parameters
+        ----------
+        channel_groups : numpy.ndarray
+            The channel groups with 1-based channel numbers.
 
-        return connectivity_features
+        Returns
+        -------
+        numpy.ndarray
+            An integer array (max_ch x groups) with the 0-based indices of the first max_ch channels of each group,
+            where max_ch is the size of the smallest group.
+        """
+        channel_lists = [np.atleast_1d(np.squeeze(ch_list)) for ch_list in channel_groups]
+        max_ch = min(len(ch_list) for ch_list in channel_lists)
+        return np.stack([ch_list[:max_ch] - 1 for ch_list in channel_lists], axis=1).astype(int)
 
     def extract_frequency_features(self, dataset, time_start=0, end_time=750, normalization='z_score'):
         """
@@ -333,10 +335,10 @@ class FeatureExtractor:
         # Convert time to indices
         start_idx, end_idx = self._time_to_indices(time_start, end_time)
 
-        for band_name, freq_range in freq_bands.items():
-            # Compute power in the given frequency band
-            band_power = self._compute_band_power(eeg_data, freq_range, start_idx, end_idx)
+        # Compute the power of all the bands from a single multitaper PSD
+        band_powers = self._compute_band_powers(eeg_data, freq_bands, start_idx, end_idx)
 
+        for band_name, band_power in band_powers.items():
             # Apply normalization
             if normalization == 'total_power':
                 total_power = np.sum(band_power, axis=-1, keepdims=True)
@@ -352,16 +354,19 @@ class FeatureExtractor:
 
         return features
 
-    def _compute_band_power(self, eeg_data, freq_range, start_idx, end_idx):
+    def _compute_band_powers(self, eeg_data, freq_bands, start_idx, end_idx):
         """
-        Compute the average power in a specific frequency band for EEG data.
+        Compute the average power in several frequency bands for EEG data.
+
+        All the trials are processed in one batch: each trial window is tapered and transformed once over the
+        union of the band ranges and the power of every band is reduced from that PSD.
 
         Parameters
         ----------
         eeg_data : numpy.ndarray
             The EEG data for power computation.
-        freq_range : tuple
-            A tuple containing the lower and upper frequency limits of the band.
+        freq_bands : dict
+            A dictionary mapping the band names to their lower and upper frequency limits.
         start_idx : int
             The starting index for the analysis.
         end_idx : int
@@ -369,20 +374,11 @@ class FeatureExtractor:
 
         Returns
         -------
-        numpy.ndarray
-            The average power in the specified frequency band.
+        dict
+            A dictionary mapping the band names to the average power with shape (trials x channels).
         """
-        band_power = []
-        for trial in eeg_data:
-            # Compute PSD using multitaper method
-            psd, freqs = psd_array_multitaper(trial[:, start_idx:end_idx], sfreq=self.fs,
-                                              fmin=freq_range[0], fmax=freq_range[1],
-                                              adaptive=True, normalization='full', verbose=False)
-            # Average power in the frequency band
-            avg_power = np.mean(psd, axis=-1)  # Average across frequencies
-
-            band_power.append(avg_power)
-        return np.array(band_power)
+        return multitaper_band_power(eeg_data[:, :, start_idx:end_idx], sfreq=self.fs, freq_bands=freq_bands,
+                                     adaptive=True, normalization='full')
 
     def _time_to_indices(self, start_time, end_time):
         """
@@ -404,38 +400,38 @@ class FeatureExtractor:
         end_index = np.argmin(np.abs(self.time - end_time))
         return start_index, end_index
 
-    def save_features(self, features, file_path):
+    def save_features(self, features_df, file_path, feature_columns):
         """
-        Save extracted features to a file.
+        Save extracted features to a columnar feature file.
 
         Parameters
         ----------
-        features : dict
-            The extracted features to be saved.
+        features_df : pandas.DataFrame
+            The extracted features, patient information and labels to be saved.
         file_path : str
             The file path where the features will be saved.
+        feature_columns : list of str
+            The names of the feature columns, which are stored as float32.
         """
+        save_feature_frame(features_df, file_path, feature_columns)
 
-        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
-        with open(file_path, 'wb') as f:
-            pkl.dump(features, f)
-
-    def load_features(self, file_path):
+    def load_features(self, file_path, feature_columns=None):
         """
-        Load features from a file.
+        Load features from a columnar feature file.
 
         Parameters
         ----------
         file_path : str
             The file path from which to load the features.
+        feature_columns : list of str or None
+            If given, only these feature columns are read together with the patient information and labels.
 
         Returns
         -------
-        dict
+        pandas.DataFrame
             The loaded features.
         """
-        with open(file_path, 'rb') as f:
-            return pkl.load(f)
+        return load_feature_frame(file_path, feature_columns=feature_columns)
 
     def process_patient_features(self, patient_id, patient_features, eeg_dataset):
         """
@@ -456,6 +452,8 @@ class FeatureExtractor:
 
         for feature_name, subject_features in patient_features.items():
             if not (feature_name.startswith('coh_') and feature_name.endswith('_freqs')):
+                # Flatten multi-dimensional features such as the coherence vectors (trials x freqs x groups)
+                subject_features = subject_features.reshape(subject_features.shape[0], -1)
                 feature_labels = self.get_feature_labels(feature_name, subject_features, channel_names)
                 if subject_features.shape[-1] != len(feature_labels):
                     raise ValueError("Feature labels should be the same size as subject features.")
@@ -1,19 +1,33 @@
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from threadpoolctl import threadpool_limits
+
 from src.settings import Paths, Settings
 from src.data_loader import VerbMemEEGDataLoader, PilotEEGDataLoader, CLEARDataLoader
 from src.feature_extraction import FeatureExtractor
+from src.feature_extraction.feature_store import FEATURE_FILE_EXTENSION, load_feature_frame, migrate_csv_feature_file
 from src.data_preprocess import DataPreprocessor
 from src.model.utils.training_utils import *
+from src.utils import PRE_SELECTED_FEATURES, get_drop_columns
 
 
 def load_or_extract_features(settings, paths):
     """
         Load or extract features for all patients specified in the settings.
 
-        This function checks if the features for each patient are already saved as a CSV file.
+        This function checks if the features for each patient are already saved as a feature file.
         If the features are found and the `load_features` setting is enabled, the function
-        loads the features from the CSV file. Otherwise, it extracts the features from the raw
+        loads the features from the feature file. Otherwise, it extracts the features from the raw
         EEG data, saves them (if `save_features` is enabled), and appends the DataFrame to the list.
+        Feature files saved as CSV by previous versions are converted to the columnar format on the
+        first load. With the 'pre_selected' feature selection method, only the pre-selected feature
+        columns are read.
+
+        If `num_workers` is larger than 1, the patients without saved features are processed in
+        parallel worker processes (see extract_features_in_parallel) and their features are then
+        loaded from the feature files written by the workers.
 
         Args:
             settings (Settings): The settings object containing configurations.
@@ -22,14 +36,25 @@ def load_or_extract_features(settings, paths):
         Returns:
             List[pd.DataFrame]: A list of DataFrames, each containing the features for a patient.
     """
+    feature_columns = None
+    if settings.features_selection_method.lower() == 'pre_selected':
+        feature_columns = PRE_SELECTED_FEATURES
+
+    parallel_extraction = settings.num_workers > 1
+    if parallel_extraction:
+        patients_to_extract = [patient for patient in settings.patient if not settings.load_features
+                               or len(get_feature_files(patient, settings, paths)) == 0]
+        extract_features_in_parallel(patients_to_extract, settings, paths)
+
     features_raw_df_dict = {}
     for patient in settings.patient:
-        file_list = [file for file in os.listdir(paths.feature_path) if
-                     file.endswith('.csv') and patient in file and settings.dataset_task in file]
-        if settings.load_features and len(file_list)>0:
+        file_list = get_feature_files(patient, settings, paths) if settings.load_features or parallel_extraction \
+            else []
+        if len(file_list)>0:
             features_raw_df = {}
             for file in file_list:
-                features_raw_df['_'.join(file.split('_')[:-1])] = pd.read_csv(paths.feature_path+file)
+                features_raw_df['_'.join(file.split('_')[:-1])] = load_feature_frame(
+                    os.path.join(paths.feature_path, file), feature_columns=feature_columns)
         else:
             features_raw_df = extract_features_for_patient(patient, settings, paths)
             # if settings.save_features:
@@ -38,6 +63,63 @@ def load_or_extract_features(settings, paths):
     return features_raw_df_dict
 
 
+def get_feature_files(patient, settings, paths):
+    """
+    List the feature files of a patient, converting the CSV feature files of previous versions if needed.
+
+    Args:
+        patient (str): The identifier of the patient.
+        settings (Settings): The settings object containing configurations.
+        paths (Paths): The paths object containing file paths.
+
+    Returns:
+        List[str]: The names of the columnar feature files of the patient.
+    """
+    patient_files = [file for file in os.listdir(paths.feature_path) if
+                     patient in file and settings.dataset_task in file]
+    file_list = [file for file in patient_files if file.endswith(FEATURE_FILE_EXTENSION)]
+    if len(file_list) == 0:
+        csv_files = [file for file in patient_files if file.endswith('_features.csv')]
+        for file in csv_files:
+            parquet_file = migrate_csv_feature_file(os.path.join(paths.feature_path, file),
+                                                    non_feature_columns=get_drop_columns(settings))
+            file_list.append(os.path.basename(parquet_file))
+    return file_list
+
+
+def extract_features_in_parallel(patients, settings, paths):
+    """
+    Load, preprocess, and extract the features of several patients in parallel worker processes.
+
+    Each worker runs extract_features_for_patient for one patient at a time and saves the features to the
+    feature files instead of sending them back, so at most `num_workers` patients are held in memory at once.
+    The threads of the numerical libraries are split between the workers.
+
+    Args:
+        patients (List[str]): The identifiers of the patients to process.
+        settings (Settings): The settings object containing configurations.
+        paths (Paths): The paths object containing file paths.
+    """
+    num_workers = min(settings.num_workers, len(patients))
+    if num_workers == 0:
+        return
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    # Spawned workers do not inherit the torch and HDF5 state of the parent process
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(_save_patient_features, patient, settings, paths, num_threads)
+                   for patient in patients]
+        for future in as_completed(futures):
+            print(f"Features of patient {future.result()} are saved")
+
+
+def _save_patient_features(patient, settings, paths, num_threads):
+    threadpool_limits(limits=num_threads)
+    settings.save_features = True
+    extract_features_for_patient(patient, settings, paths)
+    return patient
+
+
 def extract_features_for_patient(patient, settings, paths):
     """
     Load, preprocess, and extract features from EEG data for a specific patient.
@@ -0,0 +1,111 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FEATURE_FILE_EXTENSION = '.parquet'
+_FEATURE_COLUMNS_KEY = b'feature_columns'
+
+
+def save_feature_frame(features_df, file_path, feature_columns):
+    """
+    Save a feature DataFrame to a columnar Parquet feature file.
+
+    The feature columns are stored as float32 and their names are kept in the file metadata, so they can be
+    projected on load without reading the rest of the file. The other columns (patient ids, file names and
+    labels) are stored with their own types.
+
+    Parameters
+    ----------
+    features_df : pandas.DataFrame
+        The features, patient information and labels of one patient.
+    file_path : str
+        The path of the feature file.
+    feature_columns : list of str
+        The names of the feature columns in features_df.
+    """
+    features_df = features_df.astype({column: np.float32 for column in feature_columns})
+    table = pa.Table.from_pandas(features_df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_FEATURE_COLUMNS_KEY] = json.dumps(list(feature_columns)).encode('utf-8')
+
+    Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table.replace_schema_metadata(metadata), file_path)
+
+
+def read_feature_columns(file_path):
+    """
+    Read the names of the feature and non-feature columns of a feature file without loading its data.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the feature file.
+
+    Returns
+    -------
+    tuple
+        The list of feature columns and the list of the other columns.
+    """
+    schema = pq.read_schema(file_path)
+    feature_columns = json.loads(schema.metadata[_FEATURE_COLUMNS_KEY].decode('utf-8'))
+    feature_set = set(feature_columns)
+    other_columns = [column for column in schema.names if column not in feature_set]
+    return feature_columns, other_columns
+
+
+def load_feature_frame(file_path, feature_columns=None):
+    """
+    Load a feature DataFrame from a Parquet feature file.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the feature file.
+    feature_columns : list of str or None
+        If given, only these feature columns are read together with all the non-feature columns.
+        Features that are not in the file are ignored.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The loaded features, with float32 feature columns.
+    """
+    if feature_columns is None:
+        return pd.read_parquet(file_path)
+
+    stored_features, other_columns = read_feature_columns(file_path)
+    stored_set = set(stored_features)
+    columns = other_columns + [column for column in feature_columns if column in stored_set]
+    return pd.read_parquet(file_path, columns=columns)
+
+
+def migrate_csv_feature_file(csv_file_path, non_feature_columns):
+    """
+    Convert a CSV feature file written by the previous versions into a Parquet feature file.
+
+    The Parquet file is written next to the CSV file, which is left untouched.
+
+    Parameters
+    ----------
+    csv_file_path : str
+        The path of the CSV feature file.
+    non_feature_columns : list of str
+        The patient information and label columns; every other numeric column is treated as a feature.
+
+    Returns
+    -------
+    str
+        The path of the Parquet feature file.
+    """
+    features_df = pd.read_csv(csv_file_path, index_col=0)
+    feature_columns = [column for column in features_df.columns if column not in non_feature_columns
+                       and pd.api.types.is_numeric_dtype(features_df[column])]
+
+    parquet_file_path = os.path.splitext(csv_file_path)[0] + FEATURE_FILE_EXTENSION
+    save_feature_frame(features_df, parquet_file_path, feature_columns)
+    return parquet_file_path
@@ -1,3 +1,4 @@
 from .model_xgboost import *
 from .model_ldgd import *
-from .model_fast_ldgd import *
\ No newline at end of file
+from .model_fast_ldgd import *
+from .model_export import *
\ No newline at end of file
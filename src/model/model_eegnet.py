@@ -1,7 +1,8 @@
+import os
+
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 from sklearn.metrics import roc_auc_score, precision_score, recall_score, accuracy_score, f1_score
 
@@ -79,40 +80,114 @@ class EEGNet(nn.Module):
 
         return y
 
-    def fit(self, data_train, y_train, data_val, y_val, batch_size, optimizer, criterion, epochs):
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def to_tensor(self, data, channels_last=False):
+        """
+        Convert an array to a contiguous float32 tensor on the device of the model.
+
+        Parameters
+        ----------
+        data : numpy.ndarray or torch.Tensor
+            The data, e.g. trials with shape (n_trials, 1, n_channels, n_samples).
+        channels_last : bool
+            If True, 4-D data are stored in the channels_last memory format.
+
+        Returns
+        -------
+        torch.Tensor
+            The data on the device of the model.
+        """
+        tensor = torch.as_tensor(np.ascontiguousarray(data, dtype=np.float32)) if not torch.is_tensor(data) \
+            else data.float()
+        tensor = tensor.to(self.device)
+        if channels_last and tensor.dim() == 4:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
+
+    def fit(self, data_train, y_train, data_val, y_val, batch_size, optimizer, criterion, epochs, num_threads=None,
+            channels_last=False, use_bf16=False, path_model=None):
+        """
+        Train the network on the device of its parameters (move it with .to(device) first).
+
+        The data are converted once to float32 tensors on that device and the batches are drawn from them by index.
+        The metrics are accumulated on the device and read once per epoch. The weights of the epoch with the lowest
+        validation loss are kept in memory, restored at the end of the training, and saved once to path_model.
+
+        Parameters
+        ----------
+        data_train, y_train, data_val, y_val : numpy.ndarray or torch.Tensor
+            The training and validation trials and labels.
+        batch_size : int
+            The number of trials per batch.
+        optimizer : torch.optim.Optimizer
+            The optimizer of the network parameters.
+        criterion : torch.nn.Module
+            The loss function.
+        epochs : int
+            The number of epochs.
+        num_threads : int or None
+            The number of CPU threads used by torch; None keeps the current setting.
+        channels_last : bool
+            If True, the network and the trials use the channels_last memory format.
+        use_bf16 : bool
+            If True, the forward passes run under bfloat16 autocast; the loss is computed in float32.
+        path_model : str or None
+            The folder where the best weights are saved as eegnet_best_model.pth; None does not save them.
+
+        Returns
+        -------
+        dict
+            The history of the training and validation metrics.
+        """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if channels_last:
+            # Only the 4-D convolution weights have a memory format; the lazy dense layer may not be initialized yet
+            for module in self.modules():
+                if isinstance(module, nn.Conv2d):
+                    module.to(memory_format=torch.channels_last)
+        device = self.device
+
+        data_train = self.to_tensor(data_train, channels_last=channels_last)
+        y_train = self.to_tensor(y_train)
+        data_val = self.to_tensor(data_val, channels_last=channels_last)
+        y_val = self.to_tensor(y_val)
+
         self.criterion = criterion
         self.metric_monitor = Metrics()
         self.metric_monitor.initiate_history()
         best_val_loss = np.inf
+        best_state = None
         for epoch in range(epochs):
             self.train()
-            permutation = torch.randperm(data_train.shape[0])
+            permutation = torch.randperm(data_train.shape[0], device=device)
             self.metric_monitor.reset_temp()
             for i in range(0, data_train.shape[0], batch_size):
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 indices = permutation[i:i + batch_size]
-                batch_x, batch_y = torch.Tensor(data_train[indices]), torch.Tensor(y_train[indices])
-                batch_x, batch_y = Variable(batch_x.cuda(0)), Variable(batch_y.cuda(0))
-                output = self(batch_x)
-                loss = criterion(output, batch_y.float())
+                batch_x, batch_y = data_train[indices], y_train[indices]
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                    output = self(batch_x)
+                output = output.float()
+                loss = criterion(output, batch_y)
                 loss.backward()
                 optimizer.step()
-                self.metric_monitor.add_metrics(batch_y.cpu().numpy(), output.cpu().detach().numpy(), loss.item(),
-                                                train=True)
-            num_iterations = data_train.shape[0] // batch_size + 1
-            self.metric_monitor.update_metrics(num_iterations=num_iterations, train=True)
+                self.metric_monitor.add_metrics(batch_y, output.detach(), loss.detach(), train=True)
+            self.metric_monitor.update_metrics(train=True)
             self.eval()
             with torch.no_grad():
                 for i in range(0, data_val.shape[0], batch_size):
-                    batch_x, batch_y = torch.Tensor(data_val[i:i + batch_size]), torch.Tensor(y_val[i:i + batch_size])
-                    batch_x, batch_y = Variable(batch_x.cuda(0)), Variable(batch_y.cuda(0))
-                    output = self(batch_x)
+                    batch_x, batch_y = data_val[i:i + batch_size], y_val[i:i + batch_size]
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                        output = self(batch_x)
+                    output = output.float()
 
-                    loss = criterion(output, batch_y.float())
-                    self.metric_monitor.add_metrics(batch_y.cpu().numpy(), output.cpu().detach().numpy(), loss.item(),
-                                                    train=False)
-            num_iterations = data_val.shape[0] // batch_size + 1
-            self.metric_monitor.update_metrics(num_iterations=num_iterations, train=False)
+                    loss = criterion(output, batch_y)
+                    self.metric_monitor.add_metrics(batch_y, output, loss, train=False)
+            self.metric_monitor.update_metrics(train=False)
 
             print(
                 f'Epoch {epoch + 1}/{epochs} - Loss: {self.metric_monitor.history["loss_train"][-1]} - '
@@ -122,23 +197,29 @@ class EEGNet(nn.Module):
 
             if self.metric_monitor.history['loss_val'][-1] < best_val_loss:
                 best_val_loss = self.metric_monitor.history['loss_val'][-1]
-                torch.save(self.state_dict(), 'best_model.pth')
-        torch.load('best_model.pth')
+                best_state = {key: value.detach().clone() for key, value in self.state_dict().items()}
+
+        if best_state is not None:
+            self.load_state_dict(best_state)
+            if path_model is not None:
+                os.makedirs(path_model, exist_ok=True)
+                torch.save(best_state, os.path.join(path_model, 'eegnet_best_model.pth'))
         return self.metric_monitor.history
 
-    def predict(self, data, batch_size):
+    def predict(self, data, batch_size, channels_last=False, use_bf16=False):
         self.eval()
+        device = self.device
+        data = self.to_tensor(data, channels_last=channels_last)
         predictions = []
         with torch.no_grad():
             for i in range(0, data.shape[0], batch_size):
-                batch_x = torch.Tensor(data[i:i + batch_size])
-                batch_x = Variable(batch_x.cuda(0))
-                output = self(batch_x)
-                predictions.append(output.cpu().detach().numpy())
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                    output = self(data[i:i + batch_size])
+                predictions.append(output.float().cpu().numpy())
         return predictions
 
-    def evaluate(self, data, y_true, batch_size):
-        y_predicted = self.predict(data, batch_size)
+    def evaluate(self, data, y_true, batch_size, channels_last=False, use_bf16=False):
+        y_predicted = self.predict(data, batch_size, channels_last=channels_last, use_bf16=use_bf16)
         y_predicted = np.concatenate(y_predicted)
         y_true = np.array(y_true)
         loss = self.criterion(torch.Tensor(y_predicted), torch.Tensor(y_true))
@@ -158,6 +239,13 @@ class EEGNet(nn.Module):
 
 
 class Metrics:
+    """
+    Loss and binary classification metrics of the training and validation epochs.
+
+    The batches add their loss sum and confusion counts to tensors on the device of the outputs, and their outputs
+    are kept there for the ROC AUC; update_metrics reads them once per epoch.
+    """
+
     def __init__(self):
         self.history = {
             'accuracy_train': [],
@@ -173,66 +261,50 @@ class Metrics:
             'roc_auc_val': [],
             'loss_val': []
         }
-        self.temp = {
-            'accuracy_train': 0,
-            'precision_train': 0,
-            'recall_train': 0,
-            'f1_train': 0,
-            'roc_auc_train': [],
-            'loss_train': [],
-            'accuracy_val': [],
-            'precision_val': [],
-            'recall_val': [],
-            'f1_val': [],
-            'roc_auc_val': [],
-            'loss_val': []
-        }
+        self.reset_temp()
 
     def reset_temp(self):
-        self.temp = {
-            'accuracy_train': 0,
-            'precision_train': 0,
-            'recall_train': 0,
-            'f1_train': 0,
-            'roc_auc_train': 0,
-            'loss_train': 0,
-            'accuracy_val': 0,
-            'precision_val': 0,
-            'recall_val': 0,
-            'f1_val': 0,
-            'roc_auc_val': 0,
-            'loss_val': 0
-        }
+        # Per split: the running [loss sum, true positives, false positives, false negatives, true negatives] and
+        # the outputs and labels of the batches
+        self.temp = {suffix: {'counts': None, 'y_true': [], 'y_pred': []} for suffix in ['train', 'val']}
 
     def add_metrics(self, y_true, y_pred, loss, train=False):
-        if train:
-            suffix = 'train'
-        else:
-            suffix = 'val'
-
-        self.temp['loss_' + suffix] += loss
-        self.temp['accuracy_' + suffix] += accuracy_score(y_true, y_pred > 0.5)
-        self.temp['precision_' + suffix] += precision_score(y_true, y_pred > 0.5)
-        self.temp['recall_' + suffix] += recall_score(y_true, y_pred > 0.5)
-        self.temp['f1_' + suffix] += f1_score(y_true, y_pred > 0.5)
-
-        try:
-            self.temp['roc_auc_' + suffix] += roc_auc_score(y_true, y_pred)
-        except:
-            self.temp['roc_auc_' + suffix] += 50
-
-    def update_metrics(self, num_iterations, train=False):
-        if train:
-            suffix = 'train'
-        else:
-            suffix = 'val'
-        self.history['loss_' + suffix].append(self.temp['loss_' + suffix] / num_iterations)
-        self.history['accuracy_' + suffix].append(self.temp['accuracy_' + suffix] / num_iterations)
-        self.history['precision_' + suffix].append(self.temp['precision_' + suffix] / num_iterations)
-        self.history['recall_' + suffix].append(self.temp['recall_' + suffix] / num_iterations)
-        self.history['f1_' + suffix].append(self.temp['f1_' + suffix] / num_iterations)
-        self.history['roc_auc_' + suffix].append(self.temp['roc_auc_' + suffix] / num_iterations)
+        suffix = 'train' if train else 'val'
+        temp = self.temp[suffix]
+
+        y_true = y_true.detach().reshape(-1) > 0.5
+        y_pred = y_pred.detach().float().reshape(-1)
+        predicted = y_pred > 0.5
+        counts = torch.stack([loss.detach().float() * y_true.shape[0],
+                              (predicted & y_true).sum(),
+                              (predicted & ~y_true).sum(),
+                              (~predicted & y_true).sum(),
+                              (~predicted & ~y_true).sum()])
+        temp['counts'] = counts if temp['counts'] is None else temp['counts'] + counts
+        temp['y_true'].append(y_true)
+        temp['y_pred'].append(y_pred)
+
+    def update_metrics(self, train=False):
+        suffix = 'train' if train else 'val'
+        temp = self.temp[suffix]
+
+        # Single host synchronization of the epoch
+        loss_sum, tp, fp, fn, tn = temp['counts'].cpu().tolist()
+        y_true = torch.cat(temp['y_true']).cpu().numpy()
+        y_pred = torch.cat(temp['y_pred']).cpu().numpy()
+
+        num_samples = tp + fp + fn + tn
+        precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+        recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+        self.history['loss_' + suffix].append(loss_sum / num_samples)
+        self.history['accuracy_' + suffix].append((tp + tn) / num_samples)
+        self.history['precision_' + suffix].append(precision)
+        self.history['recall_' + suffix].append(recall)
+        self.history['f1_' + suffix].append(2 * tp / (2 * tp + fp + fn) if tp > 0 else 0.0)
+        self.history['roc_auc_' + suffix].append(roc_auc_score(y_true, y_pred) if 0 < y_true.sum() < len(y_true)
+                                                 else 0.5)
 
+        self.temp[suffix] = {'counts': None, 'y_true': [], 'y_pred': []}
         return self.history
 
     def initiate_history(self):
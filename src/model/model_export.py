@@ -0,0 +1,145 @@
+import copy
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+INPUT_SHAPE_FILE = 'input_shape.json'
+
+
+def export_module(module, example_trial, file_path, quantize=False, file_format='torchscript'):
+    """
+    Export a trained network for low-latency inference on single trials.
+
+    The network is copied to the CPU in evaluation mode, its lazy layers are materialized with the example trial,
+    and it is saved as a frozen TorchScript module or as an ONNX graph. The shape of one trial is stored with the
+    TorchScript module so that TrialPredictor can add the batch axis.
+
+    Parameters
+    ----------
+    module : torch.nn.Module
+        The trained network, taking batches of trials.
+    example_trial : numpy.ndarray or torch.Tensor
+        One trial, without the batch axis, e.g. (1, n_channels, n_samples) for EEGNet or (n_features,) for an
+        encoder.
+    file_path : str
+        The path of the exported file.
+    quantize : bool
+        If True, the linear layers are dynamically quantized to int8 for CPU inference (TorchScript only).
+    file_format : {'torchscript', 'onnx'}
+        The format of the exported file.
+
+    Returns
+    -------
+    torch.nn.Module
+        The exported (materialized, frozen and possibly quantized) network.
+    """
+    if file_format not in ['torchscript', 'onnx']:
+        raise ValueError("file_format should be 'torchscript' or 'onnx'")
+    if quantize and file_format == 'onnx':
+        raise ValueError("Dynamically quantized networks can only be exported to TorchScript")
+
+    module = copy.deepcopy(module).cpu().eval()
+    example = torch.as_tensor(np.asarray(example_trial, dtype=np.float32))[None]
+    with torch.no_grad():
+        module(example)
+
+    if quantize:
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+
+    if file_format == 'onnx':
+        torch.onnx.export(module, example, file_path, input_names=['trial'], output_names=['output'],
+                          dynamic_axes={'trial': {0: 'batch'}, 'output': {0: 'batch'}})
+        return module
+
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(module, example))
+    torch.jit.save(scripted, file_path, _extra_files={INPUT_SHAPE_FILE: json.dumps(list(example.shape[1:]))})
+    return scripted
+
+
+def export_eegnet(model, example_trial, file_path, quantize=False, file_format='torchscript'):
+    """
+    Export a trained EEGNet with its BatchNorm layers folded into the preceding convolutions.
+
+    Parameters
+    ----------
+    model : EEGNet
+        The trained network.
+    example_trial : numpy.ndarray
+        One trial, with shape (n_channels, n_samples).
+    file_path : str
+        The path of the exported file.
+    quantize : bool
+        If True, the dense layer is dynamically quantized to int8.
+    file_format : {'torchscript', 'onnx'}
+        The format of the exported file.
+
+    Returns
+    -------
+    torch.nn.Module
+        The exported network.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for conv_name, batchnorm_name in [('conv1', 'batchnorm1'), ('conv2', 'batchnorm2'),
+                                      ('Separable_conv2D_point', 'Batch_normalization_3')]:
+        setattr(model, conv_name, fuse_conv_bn_eval(getattr(model, conv_name), getattr(model, batchnorm_name)))
+        setattr(model, batchnorm_name, nn.Identity())
+
+    return export_module(model, np.asarray(example_trial)[None], file_path, quantize=quantize,
+                         file_format=file_format)
+
+
+class TrialPredictor:
+    """
+    Score single trials with a network exported by export_module or export_eegnet.
+
+    Only torch and NumPy are used at inference: a trial is converted without copy when possible, the batch axis is
+    added, and the exported network is run in inference mode.
+
+    Parameters
+    ----------
+    file_path : str
+        The path of the exported TorchScript (.pt) or ONNX (.onnx) file. ONNX files need onnxruntime.
+    num_threads : int
+        The number of CPU threads used for inference; one thread gives the lowest latency for single trials.
+    """
+
+    def __init__(self, file_path, num_threads=1):
+        self.file_path = file_path
+        if file_path.endswith('.onnx'):
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = num_threads
+            self._session = onnxruntime.InferenceSession(file_path, options, providers=['CPUExecutionProvider'])
+            self.input_shape = tuple(self._session.get_inputs()[0].shape[1:])
+            self._model = None
+        else:
+            torch.set_num_threads(num_threads)
+            extra_files = {INPUT_SHAPE_FILE: ''}
+            self._model = torch.jit.load(file_path, map_location='cpu', _extra_files=extra_files).eval()
+            self.input_shape = tuple(json.loads(extra_files[INPUT_SHAPE_FILE]))
+            self._session = None
+
+    def predict(self, trial):
+        """
+        Score one trial.
+
+        Parameters
+        ----------
+        trial : numpy.ndarray
+            The trial, e.g. an epoch with shape (n_channels, n_samples) for EEGNet.
+
+        Returns
+        -------
+        numpy.ndarray
+            The output of the network for the trial.
+        """
+        trial = np.ascontiguousarray(trial, dtype=np.float32).reshape((1,) + self.input_shape)
+        if self._session is not None:
+            return self._session.run(None, {self._session.get_inputs()[0].name: trial})[0][0]
+        with torch.inference_mode():
+            return self._model(torch.from_numpy(trial))[0].numpy()
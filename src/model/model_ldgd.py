@@ -83,6 +83,7 @@ def train_ldgd(data_train, labels_train, data_test, labels_test, y_train, y_test
             json.dump(model_settings, f, indent=2)
     else:
         losses = []
+        history_train = None
         model.load_weights(save_path)
 
     predictions, metrics, history_test, loss_terms_test, report_results = model.evaluate(yn_test=data_test,
@@ -155,12 +156,14 @@ def train_ldgd(data_train, labels_train, data_test, labels_test, y_train, y_test
                                    device=device,
                                    heat_map_mode='prob', show_legend=False)
 
-        visualization.animate_train(point_history=history_train['x_mu_list'],
-                                    labels=np.squeeze(labels_train),
-                                    file_name='train_animation_with_inducing_ldgd',
-                                    save_path=save_path,
-                                    inverse_length_scale=alpha_cls,
-                                    inducing_points_history=(history_train['z_list_reg'], history_train['z_list_cls']))
+        if history_train is not None:
+            visualization.animate_train(point_history=history_train['x_mu_list'],
+                                        labels=np.squeeze(labels_train),
+                                        file_name='train_animation_with_inducing_ldgd',
+                                        save_path=save_path,
+                                        inverse_length_scale=alpha_cls,
+                                        inducing_points_history=(history_train['z_list_reg'],
+                                                                 history_train['z_list_cls']))
 
         visualization.animate_train(point_history=history_test['x_mu_list'],
                                     labels=np.squeeze(labels_test),
@@ -1,47 +1,192 @@
+import hashlib
+
 import xgboost as xgb
-from sklearn.model_selection import RandomizedSearchCV
+from sklearn.model_selection import ParameterSampler, StratifiedKFold, KFold, train_test_split
 import os
 from sklearn.metrics import f1_score, classification_report, accuracy_score, precision_score, recall_score
 import numpy as np
-import xgboost as xgb
 
 import json
 from imblearn.over_sampling import SMOTE
 
 
+def feature_hash(features):
+    """
+    Hash the content of a feature matrix.
+
+    Parameters
+    ----------
+    features : numpy.ndarray
+        The feature matrix.
+
+    Returns
+    -------
+    str
+        The hexadecimal SHA-1 digest of the shape, data type and values of the matrix.
+    """
+    features = np.ascontiguousarray(features)
+    digest = hashlib.sha1(f'{features.shape}{features.dtype.str}'.encode('utf-8'))
+    digest.update(features.view(np.uint8))
+    return digest.hexdigest()
+
+
+def get_feature_importances(booster, num_features):
+    """
+    Normalized average gain of every feature, as XGBClassifier.feature_importances_.
+    """
+    scores = booster.get_score(importance_type='gain')
+    feature_importances = np.array([scores.get(f'f{i}', 0.0) for i in range(num_features)], dtype=np.float32)
+    total = feature_importances.sum()
+    return feature_importances / total if total > 0 else feature_importances
+
+
+def get_xgb_params(labels_train, balance_method='weighting', multi_strategy='one_output_per_tree', max_depth=6,
+                   n_jobs=None):
+    """
+    Build the booster parameters for binary, multi-class or multi-label targets.
+
+    Parameters
+    ----------
+    labels_train : numpy.ndarray
+        The training labels, with shape (n_train,) or (n_train, n_targets).
+    balance_method : {'weighting', 'smote', None}
+        With 'weighting', the positive labels are weighted by the ratio of negative to positive labels. SMOTE is
+        applied to the data by the caller and is not available for multi-label targets.
+    multi_strategy : {'one_output_per_tree', 'multi_output_tree'}
+        For multi-label targets, 'one_output_per_tree' grows one tree per target and round on the shared
+        histograms; 'multi_output_tree' grows trees with vector leaves that cover all the targets at once, which
+        is only faster with shallow trees.
+    max_depth : int
+        The maximum depth of the trees.
+    n_jobs : int or None
+        The number of threads used by XGBoost; None uses all the available cores.
+
+    Returns
+    -------
+    dict
+        The parameters of xgboost.train.
+    """
+    params = {'tree_method': 'hist', 'max_depth': max_depth}
+    if n_jobs is not None:
+        params['nthread'] = n_jobs
+
+    if np.ndim(labels_train) == 2 and np.shape(labels_train)[1] > 1:
+        if balance_method == 'smote':
+            raise ValueError("SMOTE balancing is not supported for multi-label targets, use 'weighting' instead")
+        if multi_strategy not in ['one_output_per_tree', 'multi_output_tree']:
+            raise ValueError("multi_strategy should be 'one_output_per_tree' or 'multi_output_tree'")
+        params.update(objective='binary:logistic', multi_strategy=multi_strategy)
+    elif len(np.unique(labels_train)) > 2:
+        params.update(objective='multi:softmax', num_class=2)
+        return params
+    else:
+        params['objective'] = 'binary:logistic'
+
+    if balance_method == 'weighting':
+        params['scale_pos_weight'] = 2 * np.sum(1 - labels_train) / np.sum(labels_train)
+    return params
+
 
 def train_xgb(data_train, labels_train, data_test, labels_test, paths, balance_method='weighting',
-              selected_features=None, target_columns=None):
+              selected_features=None, target_columns=None, n_jobs=None, multi_strategy='one_output_per_tree',
+              features=None, train_index=None, test_index=None, max_depth=6, num_boost_round=100,
+              early_stopping_rounds=None, validation_size=0.2, booster_params=None):
+    """
+    Train and evaluate an XGBoost model on one fold.
+
+    Binary, multi-class and multi-label targets are trained with a single hist booster on QuantileDMatrix
+    inputs; all the columns of a multi-label target are fitted by the same booster.
+
+    Parameters
+    ----------
+    data_train, labels_train, data_test, labels_test : numpy.ndarray
+        The features and labels of the fold. data_train and data_test are not used if features is given.
+    paths : Paths
+        The paths object; the report and metrics are saved in its result folder.
+    balance_method : {'weighting', 'smote', None}
+        The class balancing method (see get_xgb_params).
+    selected_features : dict or None
+        The selected features, used to print the most important features.
+    target_columns : list of str
+        The names of the targets.
+    n_jobs : int or None
+        The number of threads used by XGBoost; None uses all the available cores.
+    multi_strategy : {'one_output_per_tree', 'multi_output_tree'}
+        The tree type of multi-label targets (see get_xgb_params).
+    features : numpy.ndarray or None
+        The feature matrix of all the trials of the patient, shared by its folds. If given, the fold is taken by
+        row index with train_index and test_index, and the quantile cuts are still sketched on the training rows
+        only. XGBoost splits do not depend on the feature scaling, so the unscaled features can be passed.
+    train_index, test_index : numpy.ndarray or None
+        The trials of the fold in features.
+    max_depth : int
+        The maximum depth of the trees.
+    num_boost_round : int
+        The maximum number of boosting rounds.
+    early_stopping_rounds : int or None
+        If given, validation_size of the training trials are held out and training stops when their loss has not
+        improved for this many rounds.
+    validation_size : float
+        The fraction of the training trials held out for early stopping.
+    booster_params : dict or None
+        Other booster parameters, e.g. the best parameters of optimize_xgboost_hyperparameters without
+        'num_boost_round'.
+
+    Returns
+    -------
+    tuple
+        The metrics dictionary and the classification report dictionary.
+    """
     save_path = paths.path_result + '/xgb/'
     if os.path.exists(save_path) is False:
         os.makedirs(save_path)
-    # Create and train the XGBoost model with class weights
 
-    if len(np.unique(labels_train)) > 2:
-        model = xgb.XGBClassifier(objective="multi:softmax", num_class=2)
-    else:
-        scale_pos_weight = 1
-        if balance_method == 'smote':
-            smote = SMOTE(random_state=42)
-            data_train, labels_train = smote.fit_resample(data_train, labels_train)
-        elif balance_method == 'weighting':
-            scale_pos_weight = 2 * np.sum(1 - labels_train) / np.sum(labels_train)
+    if features is not None:
+        data_train, data_test = features[train_index], features[test_index]
+
+    params = get_xgb_params(labels_train, balance_method=balance_method, multi_strategy=multi_strategy,
+                            max_depth=max_depth, n_jobs=n_jobs)
+    params.update(booster_params or {})
 
-        model = xgb.XGBClassifier(scale_pos_weight=scale_pos_weight,
-                                  max_depth=6,
-                                  num_parallel_tree=2)
+    data_fit, labels_fit = data_train, labels_train
+    evals = []
+    if early_stopping_rounds is not None:
+        stratify = labels_train if np.ndim(labels_train) == 1 else None
+        fit_index, validation_index = train_test_split(np.arange(len(labels_train)), test_size=validation_size,
+                                                       stratify=stratify)
+        data_fit, labels_fit = data_train[fit_index], labels_train[fit_index]
+        evals = [(data_train[validation_index], labels_train[validation_index])]
 
-    model.fit(data_train, labels_train)
+    if balance_method == 'smote' and params['objective'] == 'binary:logistic':
+        smote = SMOTE(random_state=42)
+        data_fit, labels_fit = smote.fit_resample(data_fit, labels_fit)
+
+    # The quantile cuts are sketched on the training data only, and the other matrices of the fold only bin their
+    # rows with them
+    dtrain = xgb.QuantileDMatrix(data_fit, label=labels_fit, nthread=n_jobs)
+    evals = [(xgb.QuantileDMatrix(data, label=labels, ref=dtrain, nthread=n_jobs), 'validation')
+             for data, labels in evals]
+    dtest = xgb.QuantileDMatrix(data_test, ref=dtrain, nthread=n_jobs)
+
+    booster = xgb.train(params, dtrain, num_boost_round=num_boost_round, evals=evals,
+                        early_stopping_rounds=early_stopping_rounds, verbose_eval=False)
+    iteration_range = (0, booster.best_iteration + 1) if early_stopping_rounds is not None else (0, 0)
+
+    feature_importances = get_feature_importances(booster, data_train.shape[1])
     if selected_features is not None:
         key_list = list(selected_features.keys())
         feature_list = selected_features[key_list[0]]
-        feature_importance = {feature_list[i]: model.feature_importances_[i] for i in
+        feature_importance = {feature_list[i]: feature_importances[i] for i in
                               range(len(feature_list))}
         print("top 10 important features are: ",
               sorted(feature_importance.items(), key=lambda x: x[1], reverse=True)[:10])
 
     # Make predictions
-    predictions = model.predict(data_test)
+    predictions = booster.predict(dtest, iteration_range=iteration_range)
+    if params['objective'] == 'binary:logistic':
+        predictions = (predictions > 0.5).astype(int)
+    else:
+        predictions = predictions.astype(int)
 
     if len(target_columns) == 1:
         target_names = [f'{target_columns[0]}_1', f'{target_columns[0]}_1']
@@ -69,10 +214,50 @@ def train_xgb(data_train, labels_train, data_test, labels_test, paths, balance_m
     return metrics, report_results
 
 
-def optimize_xgboost_hyperparameters(X, y):
-    # Define the hyperparameter grid to search
+def optimize_xgboost_hyperparameters(X, y, patient=None, results_path=None, n_candidates=27, max_rounds=300, eta=3,
+                                     cv=3, balance_method='weighting', n_jobs=None, random_state=42):
+    """
+    Search the XGBoost hyperparameters of a patient with successive halving over the boosting rounds.
+
+    Random candidates are trained with cross-validation on a small number of rounds; only the best 1/eta of them
+    are trained further, on eta times more rounds, until a single candidate is trained on max_rounds. The
+    boosters of the kept candidates resume from their previous rounds, and they are ranked on the validation
+    history recorded by XGBoost. The quantized matrices of the folds are built once, with the quantile cuts
+    sketched on the training rows of each fold, and shared by all the candidates.
+
+    Parameters
+    ----------
+    X : numpy.ndarray
+        The training features of the patient, with shape (n_trials, n_features).
+    y : numpy.ndarray
+        The labels, with shape (n_trials,) or (n_trials, n_targets).
+    patient : str or None
+        The name of the patient, used with the hash of X to name the results file.
+    results_path : str or None
+        The folder where the search results are saved. If the results of the same patient, features and search
+        settings already exist, they are returned without searching again. None disables the persistence.
+    n_candidates : int
+        The number of random candidates of the first rung.
+    max_rounds : int
+        The number of boosting rounds of the last rung.
+    eta : int
+        The halving factor: each rung keeps 1/eta of the candidates and trains them on eta times more rounds.
+    cv : int
+        The number of cross-validation folds.
+    balance_method : {'weighting', None}
+        The class balancing method (see get_xgb_params).
+    n_jobs : int or None
+        The number of threads used by XGBoost; None uses all the available cores.
+    random_state : int
+        The seed of the candidates and of the folds.
+
+    Returns
+    -------
+    tuple
+        The best hyperparameters, with 'num_boost_round' and the booster parameters, and their cross-validated
+        accuracy.
+    """
     param_grid = {
-        'n_estimators': [100, 200, 300],  # Number of boosting rounds
         'max_depth': [3, 4, 5, 6, 7],  # Maximum depth of trees
         'learning_rate': [0.01, 0.1, 0.2, 0.3],  # Learning rate
         'subsample': [0.7, 0.8, 0.9],  # Fraction of samples used for training each tree
@@ -82,21 +267,75 @@ def optimize_xgboost_hyperparameters(X, y):
         'reg_lambda': [0, 1, 2],  # L2 regularization term on weights
         'reg_alpha': [0, 1, 2]  # L1 regularization term on weights
     }
+    search_settings = dict(n_candidates=n_candidates, max_rounds=max_rounds, eta=eta, cv=cv,
+                           balance_method=balance_method, random_state=random_state)
+
+    results_file = None
+    if results_path is not None:
+        results_file = os.path.join(results_path, f'xgb_search_{patient}_{feature_hash(X)[:16]}.json')
+        if os.path.exists(results_file):
+            with open(results_file, "r") as file:
+                results = json.load(file)
+            if results['search_settings'] == search_settings:
+                return results['best_params'], results['best_score']
+
+    # Number of rounds of each rung, from max_rounds / eta ** (n_rungs - 1) to max_rounds
+    n_rungs = int(np.floor(np.log(n_candidates) / np.log(eta) + 1e-9)) + 1
+    rung_rounds = [max(1, int(round(max_rounds * eta ** (rung - n_rungs + 1)))) for rung in range(n_rungs)]
+
+    if np.ndim(y) == 1:
+        splitter = StratifiedKFold(n_splits=cv, shuffle=True, random_state=random_state)
+    else:
+        splitter = KFold(n_splits=cv, shuffle=True, random_state=random_state)
+    folds = []
+    for train_index, validation_index in splitter.split(X, y if np.ndim(y) == 1 else None):
+        dtrain = xgb.QuantileDMatrix(X[train_index], label=y[train_index], nthread=n_jobs)
+        dvalidation = xgb.QuantileDMatrix(X[validation_index], label=y[validation_index], ref=dtrain,
+                                          nthread=n_jobs)
+        folds.append((dtrain, dvalidation))
+
+    base_params = get_xgb_params(y, balance_method=balance_method, n_jobs=n_jobs)
+    base_params.update(eval_metric=['logloss', 'error'] if base_params['objective'] == 'binary:logistic'
+                       else ['mlogloss', 'merror'], seed=random_state)
+    candidates = list(ParameterSampler(param_grid, n_iter=n_candidates, random_state=random_state))
+    boosters = [[None] * cv for _ in candidates]
+    alive = np.arange(len(candidates))
+    history = []
 
-    # Create the XGBoost classifier
-    xgb_classifier = xgb.XGBClassifier(objective="binary:logistic", eval_metric="logloss")
+    trained_rounds = 0
+    for rung, num_rounds in enumerate(rung_rounds):
+        losses, errors = np.zeros(len(alive)), np.zeros(len(alive))
+        for i, candidate in enumerate(alive):
+            params = dict(base_params, **candidates[candidate])
+            for fold, (dtrain, dvalidation) in enumerate(folds):
+                evals_result = {}
+                boosters[candidate][fold] = xgb.train(params, dtrain, num_boost_round=num_rounds - trained_rounds,
+                                                      evals=[(dvalidation, 'validation')],
+                                                      evals_result=evals_result, verbose_eval=False,
+                                                      xgb_model=boosters[candidate][fold])
+                loss_history, error_history = evals_result['validation'].values()
+                losses[i] += loss_history[-1] / cv
+                errors[i] += error_history[-1] / cv
+        history.append({'num_boost_round': num_rounds, 'candidates': alive.tolist(),
+                        'accuracy': (1 - errors).tolist(), 'loss': losses.tolist()})
 
-    # Use RandomizedSearchCV for hyperparameter optimization with cross-validation
-    randomized_search = RandomizedSearchCV(
-        xgb_classifier, param_distributions=param_grid, n_iter=50,
-        scoring="accuracy", cv=5, verbose=2, n_jobs=-1, random_state=42
-    )
+        # Keep the most accurate candidates, ties broken by the validation loss
+        order = np.lexsort((losses, errors))
+        if rung < n_rungs - 1:
+            num_kept = max(1, len(alive) // eta)
+            for candidate in alive[order[num_kept:]]:
+                boosters[candidate] = None
+            alive = alive[order[:num_kept]]
+            trained_rounds = num_rounds
 
-    # Fit the randomized search to the data
-    randomized_search.fit(X, y)
+    best = order[0]
+    best_params = dict(candidates[alive[best]], num_boost_round=rung_rounds[-1])
+    best_score = float(1 - errors[best])
 
-    # Get the best hyperparameters
-    best_params = randomized_search.best_params_
-    best_score = randomized_search.best_score_
+    if results_file is not None:
+        os.makedirs(results_path, exist_ok=True)
+        with open(results_file, "w") as file:
+            json.dump({'patient': patient, 'search_settings': search_settings, 'best_params': best_params,
+                       'best_score': best_score, 'candidates': candidates, 'rungs': history}, file, indent=2)
 
-    return best_params, best_score
\ No newline at end of file
+    return best_params, best_score
@@ -1,11 +1,19 @@
+import copy
+import multiprocessing
 import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
+import torch
 import matplotlib.pyplot as plt
+from threadpoolctl import threadpool_limits
 from sklearn.model_selection import train_test_split, StratifiedKFold
 
 from src.evaluation.evaluation import ResultList
-from src.utils import get_labels, get_correlation_single_event, get_drop_columns, get_selected_features
+from src.utils import get_labels, get_correlation_single_event, get_drop_columns, get_selected_feature_indices, \
+    FeatureScaler, FeatureMatrix
 from src.visualization.visualization_utils import plot_metric_heatmaps
 from src.model import train_xgb, train_ldgd, train_fast_ldgd
 
@@ -22,6 +30,11 @@ def train_model_with_folds(features_raw_df_dict, settings, paths, random_seed=42
     5. Evaluates the models on the test data and logs the results.
     6. Computes and saves average scores for each model across all folds (if in k-fold mode).
 
+    The (patient, fold, method) trainings are independent jobs: with `num_workers` larger than 1 the jobs of a
+    patient run in parallel worker processes (see run_training_jobs). The jobs only hold the trial and feature
+    indices of their fold; the feature matrix of the patient is shared by all of them and each job slices its
+    fold when it runs. Each job is seeded from random_seed, so the results do not depend on the number of workers.
+
     Args:
         settings (Settings): The settings object containing configurations.
         paths (Paths): The paths object containing file paths.
@@ -54,41 +67,52 @@ def train_model_with_folds(features_raw_df_dict, settings, paths, random_seed=42
         else:  # Single train/test split
             folds = [(train_test_split(np.arange(len(labels_array)), test_size=0.2, stratify=labels_array))]
 
-        fold_results = {method: [] for method in settings.method_list}
-        fold_report_results = {method: [] for method in settings.method_list}
-
+        # Convert the features once; the jobs of the folds only index its trials and columns
+        feature_matrix = FeatureMatrix(features_df, get_drop_columns(settings))
+        shared_data = dict(features=feature_matrix.values, labels=labels_array, y_one_hot=y_one_hot,
+                           settings=settings, target_columns=target_columns, xgb_features=None)
+        # XGBoost splits do not depend on the feature scaling: when the selected columns are the same for all the
+        # folds, XGBoost is trained on the unscaled features of the patient, shared by the folds and indexed by
+        # the trials of each fold
+        share_xgb_features = settings.features_selection_method.lower() in ['all', 'pre_selected']
+
+        # Select the features of every fold and prepare the training jobs of every fold and method
+        jobs = []
         for fold_idx, (train_index, test_index) in enumerate(folds):
             paths.create_fold_path(fold_idx)
-
-            # Select features and prepare the training and testing datasets
-            features_matrix, selected_features, patients_ids, _ = get_selected_features(
-                features_df=features_df.copy(), settings=settings, paths=paths,
+            column_indices, selected_features = get_selected_feature_indices(
+                features_df=features_df, settings=settings, paths=paths,
                 fold_idx=fold_idx, train_index=train_index, target_columns_drop=get_drop_columns(settings),
-                num_important_features=settings.num_important_features)
-
-            data_train, data_test = features_matrix[train_index], features_matrix[test_index]
-            labels_train, labels_test = labels_array[train_index], labels_array[test_index]
-            y_train, y_test = y_one_hot[train_index], y_one_hot[test_index]
-
-            # Train and evaluate models for each specified method
-            for method in settings.method_list:
-                print(f"=========== Train Subject {patient_id} Fold {fold_idx} Model {method} =========== \n")
-                results, report_results = train_model(method,
-                                                      data_train=data_train,
-                                                      labels_train=labels_train,
-                                                      data_test=data_test,
-                                                      labels_test=labels_test,
-                                                      settings=settings,
-                                                      paths=paths,
-                                                      y_train=y_train,
-                                                      y_test=y_test,
-                                                      selected_features=selected_features,
-                                                      target_columns=target_columns)
-                fold_results[method].append(results)
-                fold_report_results[method].append(report_results)
+                num_important_features=settings.num_important_features, feature_matrix=feature_matrix)
+            scaler = FeatureScaler(settings.feature_transformation).fit(
+                feature_matrix.values[np.ix_(train_index, column_indices)])
+
+            if share_xgb_features and shared_data['xgb_features'] is None:
+                if np.array_equal(column_indices, np.arange(feature_matrix.values.shape[1])):
+                    shared_data['xgb_features'] = feature_matrix.values
+                else:
+                    shared_data['xgb_features'] = feature_matrix.values[:, column_indices]
+
+            fold = dict(train_index=train_index, test_index=test_index, column_indices=column_indices,
+                        scaler=scaler, selected_features=selected_features, paths=copy.copy(paths))
+            for method_idx, method in enumerate(settings.method_list):
+                jobs.append({'patient_id': patient_id,
+                             'fold_idx': fold_idx,
+                             'method': method,
+                             'seed': get_job_seed(random_seed, patient_id, fold_idx, method_idx),
+                             'fold': fold})
 
             plt.close('all')
 
+        # Train and evaluate the models of all the jobs of the patient
+        job_results = run_training_jobs(jobs, num_workers=settings.num_workers, shared_data=shared_data)
+
+        fold_results = {method: [] for method in settings.method_list}
+        fold_report_results = {method: [] for method in settings.method_list}
+        for job, (results, report_results) in zip(jobs, job_results):
+            fold_results[job['method']].append(results)
+            fold_report_results[job['method']].append(report_results)
+
         # Aggregate the results for fold reports
         aggregated_results = aggregate_fold_report_results(fold_report_results)
 
@@ -118,6 +142,113 @@ def train_model_with_folds(features_raw_df_dict, settings, paths, random_seed=42
     result_df.to_csv(os.path.join(paths.base_path, paths.folder_name, f'{settings.cross_validation_mode}_results.csv'))
 
 
+def get_job_seed(random_seed, patient_id, fold_idx, method_idx):
+    """
+    Derive the random seed of a (patient, fold, method) training job from the global random seed.
+    """
+    return int(np.random.SeedSequence([random_seed, patient_id, fold_idx, method_idx]).generate_state(1)[0])
+
+
+# Data shared by the training jobs of the patient processed by a worker process, see run_training_jobs
+_shared_data = None
+
+
+def _set_shared_data(shared_data):
+    global _shared_data
+    _shared_data = shared_data
+
+
+def run_training_jobs(jobs, num_workers=1, shared_data=None):
+    """
+    Run training jobs, in parallel worker processes if num_workers is larger than 1.
+
+    The shared data are sent once to each worker process when it starts, not with every job.
+
+    Args:
+        jobs (list): The jobs, as dictionaries with the 'patient_id', 'fold_idx', 'method', 'seed' and 'fold'
+            (the trial and feature indices of the fold, see get_train_kwargs) keys.
+        num_workers (int): The number of worker processes.
+        shared_data (dict): The data of the patient shared by all the jobs (see get_train_kwargs).
+
+    Returns:
+        list: The (results, report_results) of train_model for each job, in the order of the jobs.
+    """
+    if num_workers <= 1 or len(jobs) <= 1:
+        return [run_training_job(job, shared_data=shared_data) for job in jobs]
+
+    # Split the cores between the workers so that XGBoost, torch and BLAS threads do not oversubscribe them
+    num_workers = min(num_workers, len(jobs))
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_set_shared_data, initargs=(shared_data,)) as executor:
+        return list(executor.map(run_training_job, jobs, [num_threads] * len(jobs)))
+
+
+def run_training_job(job, num_threads=None, shared_data=None):
+    """
+    Seed the random number generators and train and evaluate the model of one job.
+
+    Args:
+        job (dict): The job (see run_training_jobs).
+        num_threads (int or None): The maximum number of threads of the job; None does not limit them.
+        shared_data (dict or None): The data shared by the jobs; None uses the data sent to the worker process.
+
+    Returns:
+        tuple: The results and report results of train_model.
+    """
+    print(f"=========== Train Subject {job['patient_id']} Fold {job['fold_idx']} Model {job['method']} =========== \n")
+    random.seed(job['seed'])
+    np.random.seed(job['seed'])
+    torch.manual_seed(job['seed'])
+
+    train_kwargs = get_train_kwargs(job['method'], job['fold'], _shared_data if shared_data is None else shared_data)
+    if num_threads is None:
+        results = train_model(job['method'], **train_kwargs)
+    else:
+        torch.set_num_threads(num_threads)
+        with threadpool_limits(limits=num_threads):
+            results = train_model(job['method'], num_threads=num_threads, **train_kwargs)
+
+    plt.close('all')
+    return results
+
+
+def get_train_kwargs(method, fold, shared_data):
+    """
+    Slice the training and testing data of a fold from the data of the patient.
+
+    Args:
+        method (str): The method of the job.
+        fold (dict): The 'train_index', 'test_index', 'column_indices' (the selected features), 'scaler' (fitted
+            on the training trials), 'selected_features' and 'paths' of the fold.
+        shared_data (dict): The 'features' (FeatureMatrix values), 'labels', 'y_one_hot', 'settings',
+            'target_columns' and 'xgb_features' (the unscaled features of XGBoost or None) of the patient.
+
+    Returns:
+        dict: The arguments of train_model.
+    """
+    train_index, test_index = fold['train_index'], fold['test_index']
+    train_kwargs = dict(labels_train=shared_data['labels'][train_index],
+                        labels_test=shared_data['labels'][test_index],
+                        settings=shared_data['settings'],
+                        paths=fold['paths'],
+                        y_train=shared_data['y_one_hot'][train_index],
+                        y_test=shared_data['y_one_hot'][test_index],
+                        selected_features=fold['selected_features'],
+                        target_columns=shared_data['target_columns'])
+
+    if method.lower() == 'xgboost' and shared_data['xgb_features'] is not None:
+        # train_xgb takes the fold from the shared features by trial index
+        train_kwargs.update(data_train=None, data_test=None,
+                            xgb_data=dict(features=shared_data['xgb_features'], train_index=train_index,
+                                          test_index=test_index))
+    else:
+        features, column_indices = shared_data['features'], fold['column_indices']
+        train_kwargs.update(data_train=fold['scaler'].transform(features[np.ix_(train_index, column_indices)]),
+                            data_test=fold['scaler'].transform(features[np.ix_(test_index, column_indices)]))
+    return train_kwargs
+
+
 def setup_cross_validation(cv_mode, num_folds=5, random_state=42):
     if isinstance(cv_mode, str):
         if cv_mode == 'k-fold':
@@ -147,10 +278,11 @@ def generate_folds(features_df, labels_array, cv_mode, n_splits=5):
 
 
 def train_model(method, data_train, labels_train, data_test, labels_test, settings, paths, y_train=None, y_test=None,
-                selected_features=None, target_columns=None):
+                selected_features=None, target_columns=None, num_threads=None, xgb_data=None):
     if method.lower() == 'xgboost':
         return train_xgb(data_train, labels_train, data_test, labels_test, paths,
-                         selected_features=selected_features, target_columns=target_columns)
+                         selected_features=selected_features, target_columns=target_columns, n_jobs=num_threads,
+                         **(xgb_data or {}), **settings.xgboost_configs)
     elif method.lower() == 'ldgd':
         return train_ldgd(data_train, labels_train, data_test, labels_test, y_train, y_test, settings, paths)
     elif method.lower() == 'fast_ldgd':
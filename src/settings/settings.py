@@ -26,6 +26,8 @@ class Settings:
         self.__save_epoched_data = False
         self.__load_preprocessed_data = False
         self.__save_preprocessed_data = False
+        self.__num_workers = 1
+        self.__stream_block_seconds = None
 
         self.method_list = ['xgboost', 'ldgd']
         self.metric_list = ['accuracy', 'f1_score', 'recall', 'precision']
@@ -226,6 +228,28 @@ class Settings:
         else:
             raise ValueError("num_fold should be integer bigger than 0")
 
+    @property
+    def num_workers(self):
+        return self.__num_workers
+
+    @num_workers.setter
+    def num_workers(self, value):
+        if isinstance(value, int) and value > 0:
+            self.__num_workers = value
+        else:
+            raise ValueError("num_workers should be integer bigger than 0")
+
+    @property
+    def stream_block_seconds(self):
+        return self.__stream_block_seconds
+
+    @stream_block_seconds.setter
+    def stream_block_seconds(self, value):
+        if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+            self.__stream_block_seconds = value
+        else:
+            raise ValueError("stream_block_seconds should be null or a number bigger than 0")
+
     @property
     def test_size(self):
         return self.__test_size
@@ -1,12 +1,12 @@
 # Analysis Imports
 import math
 import numpy as np
-from scipy.signal.windows import dpss
 from scipy.signal import detrend
 # Logistical Imports
 import warnings
 import timeit
 from joblib import Parallel, delayed, cpu_count
+from src.utils.spectral_matrix.multitaper import dpss_windows, signal_chunks, tapered_fft
 # Visualization imports
 import colorcet  # this import is necessary to add rainbow colormap to matplotlib
 import matplotlib.pyplot as plt
@@ -124,8 +124,8 @@ def multitaper_spectrogram(data, fs, frequency_range=None, time_bandwidth=5, num
     #     STEP 3: Compute the spectrum for each tapered segment
     #     STEP 4: Take the mean of the tapered spectra
 
-    # Compute DPSS tapers (STEP 1)
-    dpss_tapers, dpss_eigen = dpss(winsize_samples, time_bandwidth, num_tapers, return_ratios=True)
+    # Compute DPSS tapers (STEP 1), cached per window length and bandwidth
+    dpss_tapers, dpss_eigen = dpss_windows(winsize_samples, time_bandwidth, num_tapers, sym=True)
     dpss_eigen = np.reshape(dpss_eigen, (num_tapers, 1))
 
     # pre-compute weights
@@ -147,9 +147,12 @@ def multitaper_spectrogram(data, fs, frequency_range=None, time_bandwidth=5, num
         mt_spectrogram = np.vstack(Parallel(n_jobs=n_jobs)(delayed(calc_mts_segment)(
             data_segments[num_window, :], *mts_params) for num_window in range(num_windows)))
 
-    else:  # if no multiprocessing, compute normally
+    elif weighting == 'adapt':  # adaptive weights are iterated segment by segment
         mt_spectrogram = np.apply_along_axis(calc_mts_segment, 1, data_segments, *mts_params)
 
+    else:  # if no multiprocessing, compute all the segments in batches
+        mt_spectrogram = calc_mts_segments(data_segments, *mts_params)
+
     # Compute one-sided PSD spectrum
     mt_spectrogram = mt_spectrogram.T
     dc_select = np.where(sfreqs == 0)[0]
@@ -448,6 +451,46 @@ def is_outlier(data):
     return outlier_mask
 
 
+# CALCULATE MULTITAPER SPECTRUM ON ALL SEGMENTS
+def calc_mts_segments(data_segments, dpss_tapers, nfft, freq_inds, detrend_opt, num_tapers, dpss_eigen, weighting,
+                      wt):
+    """ Helper function to calculate the multitaper spectrum of all the data segments at once with 'unity' or
+        'eigen' weighting. The segments are processed in memory-bounded batches with one FFT call per batch.
+        Arguments:
+            data_segments (2d np.array): Windows of time-series data with shape (num_windows, winsize_samples)
+            dpss_tapers, nfft, freq_inds, detrend_opt, num_tapers, dpss_eigen, weighting, wt:
+                same as calc_mts_segment()
+        Returns:
+            mt_spectrum (2d np.array): spectral power with shape (num_windows, num_frequencies)
+    """
+    if weighting == 'adapt':
+        raise ValueError("Adaptive weighting is computed segment by segment with calc_mts_segment()")
+
+    num_rfft = nfft // 2 + 1
+    freq_inds = np.asarray(freq_inds)[:num_rfft]  # frequency range never exceeds Nyquist
+    mt_spectrum = np.empty((data_segments.shape[0], int(np.sum(freq_inds))))
+
+    for chunk in signal_chunks(data_segments.shape[0], 16 * num_tapers * num_rfft):
+        segments = data_segments[chunk]
+
+        # Option to detrend data to remove low frequency DC component
+        if detrend_opt != 'off':
+            segments = detrend(segments, axis=-1, type=detrend_opt)
+
+        # Multiply data by dpss tapers and compute the FFT (STEPS 2 and 3)
+        fft_data = tapered_fft(segments, dpss_tapers, n_fft=nfft)[..., freq_inds]
+
+        # Compute the weighted mean spectral power across tapers (STEP 4)
+        spower = np.power(np.imag(fft_data), 2) + np.power(np.real(fft_data), 2)
+        mt_spectrum[chunk] = np.einsum('wkf,k->wf', spower, np.ravel(wt))
+
+    # Segments with all zeros or with NaNs are returned as zeros or NaNs
+    mt_spectrum[np.all(data_segments == 0, axis=1)] = 0
+    mt_spectrum[np.any(np.isnan(data_segments), axis=1)] = np.nan
+
+    return mt_spectrum
+
+
 # CALCULATE MULTITAPER SPECTRUM ON SINGLE SEGMENT
 def calc_mts_segment(data_segment, dpss_tapers, nfft, freq_inds, detrend_opt, num_tapers, dpss_eigen, weighting, wt):
     """ Helper function to calculate the multitaper spectrum of a single segment of data
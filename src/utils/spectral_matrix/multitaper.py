@@ -0,0 +1,434 @@
+import warnings
+from functools import lru_cache
+
+import numpy as np
+from scipy.fft import rfft, rfftfreq
+from scipy.integrate import trapezoid
+from scipy.signal.windows import dpss
+
+# Upper bound on the size of the tapered spectra held in memory at once
+MAX_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+@lru_cache(maxsize=64)
+def dpss_windows(n_times, half_nbw, n_tapers, sym=False):
+    """
+    Compute and cache the DPSS tapers and their eigenvalues.
+
+    The returned arrays are shared between calls and are read-only.
+
+    Parameters
+    ----------
+    n_times : int
+        Number of samples in the analysis window.
+    half_nbw : float
+        The normalized half-bandwidth (time-half bandwidth product).
+    n_tapers : int
+        Number of tapers to compute.
+    sym : bool
+        Compute symmetric windows (True) or periodic windows for spectral analysis (False).
+
+    Returns
+    -------
+    tuple
+        The tapers with shape (n_tapers, n_times) and their eigenvalues with shape (n_tapers,).
+    """
+    tapers, eigvals = dpss(n_times, half_nbw, n_tapers, sym=sym, norm=2, return_ratios=True)
+    tapers.setflags(write=False)
+    eigvals.setflags(write=False)
+    return tapers, eigvals
+
+
+def signal_chunks(n_signals, bytes_per_signal, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Split the signals into consecutive chunks whose intermediate arrays fit in the memory budget.
+
+    Parameters
+    ----------
+    n_signals : int
+        Number of signals to process.
+    bytes_per_signal : int
+        Memory needed by the intermediate arrays of one signal.
+    max_chunk_bytes : int
+        Memory budget of one chunk.
+
+    Returns
+    -------
+    list of slice
+        The slices of the signals in each chunk.
+    """
+    chunk_size = max(int(max_chunk_bytes // max(bytes_per_signal, 1)), 1)
+    return [slice(start, min(start + chunk_size, n_signals)) for start in range(0, n_signals, chunk_size)]
+
+
+def compute_dpss_tapers(n_times, sfreq, bandwidth=None, low_bias=True):
+    """
+    Compute the DPSS tapers and eigenvalues used for multitaper estimation.
+
+    The taper design follows ``mne.time_frequency.psd_array_multitaper`` so the estimates of this module match
+    the MNE ones. The tapers are cached per (window length, bandwidth).
+
+    Parameters
+    ----------
+    n_times : int
+        Number of samples in the analysis window.
+    sfreq : float
+        The sampling frequency.
+    bandwidth : float or None
+        Frequency bandwidth of the multitaper window in Hz. If None, a normalized half-bandwidth of 4 is used.
+    low_bias : bool
+        Only keep the tapers with eigenvalues > 0.9.
+
+    Returns
+    -------
+    tuple
+        The tapers with shape (n_tapers, n_times) and their eigenvalues with shape (n_tapers,).
+    """
+    half_nbw = 4.0 if bandwidth is None else float(bandwidth) * n_times / (2.0 * sfreq)
+    if half_nbw < 0.5:
+        raise ValueError(f"bandwidth value {bandwidth} yields a normalized half-bandwidth of {half_nbw} < 0.5, "
+                         f"use a value of at least {sfreq / n_times}")
+
+    tapers, eigvals = dpss_windows(n_times, half_nbw, int(2 * half_nbw), sym=False)
+    if low_bias:
+        keep = eigvals > 0.9
+        if not keep.any():
+            keep = [np.argmax(eigvals)]
+        tapers, eigvals = tapers[keep], eigvals[keep]
+
+    return tapers, eigvals
+
+
+def tapered_fft(data, tapers, n_fft=None):
+    """
+    Compute the one-sided FFT of the data multiplied by every taper.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The signals with shape (..., n_times).
+    tapers : numpy.ndarray
+        The tapers with shape (n_tapers, n_times).
+    n_fft : int or None
+        Length of the FFT. If None, the number of samples is used.
+
+    Returns
+    -------
+    numpy.ndarray
+        The tapered spectra with shape (..., n_tapers, n_fft // 2 + 1).
+    """
+    n_fft = data.shape[-1] if n_fft is None else n_fft
+    return rfft(data[..., np.newaxis, :] * tapers, n=n_fft, axis=-1)
+
+
+def mt_spectra(data, tapers, n_fft=None, remove_dc=True):
+    """
+    Compute the tapered spectra of the data scaled as in MNE.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The signals with shape (..., n_times).
+    tapers : numpy.ndarray
+        The DPSS tapers with shape (n_tapers, n_times).
+    n_fft : int or None
+        Length of the FFT. If None, the number of samples is used.
+    remove_dc : bool
+        Subtract the mean of each signal before tapering.
+
+    Returns
+    -------
+    numpy.ndarray
+        The tapered spectra with shape (..., n_tapers, n_freqs).
+    """
+    n_fft = data.shape[-1] if n_fft is None else n_fft
+    if remove_dc:
+        data = data - np.mean(data, axis=-1, keepdims=True)
+
+    x_mt = tapered_fft(data, tapers, n_fft=n_fft)
+    x_mt[..., 0] /= np.sqrt(2.0)
+    if n_fft % 2 == 0:
+        x_mt[..., -1] /= np.sqrt(2.0)
+
+    return x_mt
+
+
+def mt_spectra_at(data, tapers, freq_idx, n_fft=None, remove_dc=True):
+    """
+    Compute the tapered spectra of the data at a few frequency bins only, scaled as in MNE.
+
+    The selected bins of the DFT are computed with a matrix product, which is cheaper than a full FFT when only
+    a handful of frequencies are needed.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The signals with shape (..., n_times).
+    tapers : numpy.ndarray
+        The DPSS tapers with shape (n_tapers, n_times).
+    freq_idx : array-like of int
+        Indices of the rfft frequency bins to compute.
+    n_fft : int or None
+        Length of the FFT. If None, the number of samples is used.
+    remove_dc : bool
+        Subtract the mean of each signal before tapering.
+
+    Returns
+    -------
+    numpy.ndarray
+        The tapered spectra with shape (..., n_tapers, len(freq_idx)).
+    """
+    n_times = data.shape[-1]
+    n_fft = n_times if n_fft is None else n_fft
+    freq_idx = np.asarray(freq_idx)
+    if remove_dc:
+        data = data - np.mean(data, axis=-1, keepdims=True)
+
+    # Tapered DFT basis with shape (n_tapers * n_freqs, n_times)
+    basis = np.exp(-2j * np.pi * np.outer(freq_idx, np.arange(n_times)) / n_fft)
+    kernel = (tapers[:, np.newaxis, :] * basis).reshape(-1, n_times)
+
+    x_mt = (data @ kernel.T).reshape(data.shape[:-1] + (tapers.shape[0], len(freq_idx)))
+    x_mt[..., (freq_idx == 0) | (2 * freq_idx == n_fft)] /= np.sqrt(2.0)
+
+    return x_mt
+
+
+def psd_from_mt(x_mt, weights):
+    """
+    Combine the tapered spectra into a PSD using the given taper weights.
+
+    Parameters
+    ----------
+    x_mt : numpy.ndarray
+        The tapered spectra with shape (..., n_tapers, n_freqs).
+    weights : numpy.ndarray
+        The taper weights, broadcastable to ``x_mt``.
+
+    Returns
+    -------
+    numpy.ndarray
+        The PSD with shape (..., n_freqs).
+    """
+    psd = weights * x_mt
+    psd = (psd * psd.conj()).real.sum(axis=-2)
+    psd *= 2 / (weights * np.conj(weights)).real.sum(axis=-2)
+    return psd
+
+
+def psd_from_mt_adaptive(x_mt, eigvals, x_var, max_iter=250):
+    """
+    Compute the PSD from tapered spectra with adaptive taper weights.
+
+    This is the iterative procedure of Percival & Walden used by MNE, vectorized over all signals. Every signal
+    keeps iterating until its own weights converge, so the result is the same as running the procedure signal
+    by signal.
+
+    Parameters
+    ----------
+    x_mt : numpy.ndarray
+        The tapered spectra with shape (n_signals, n_tapers, n_freqs), restricted to the frequencies of interest.
+    eigvals : numpy.ndarray
+        The eigenvalues of the DPSS tapers.
+    x_var : numpy.ndarray
+        The variance of each signal with shape (n_signals,), see ``signal_variance``.
+    max_iter : int
+        Maximum number of iterations for the weight computation.
+
+    Returns
+    -------
+    numpy.ndarray
+        The PSD with shape (n_signals, n_freqs).
+    """
+    if x_mt.shape[1] < 3:
+        raise ValueError("Not enough tapers to compute adaptive weights.")
+
+    rt_eig = np.sqrt(eigvals)[:, np.newaxis]
+    eig = eigvals[:, np.newaxis]
+
+    psd = psd_from_mt(x_mt[:, :2, :], rt_eig[:2])
+    err = np.zeros(x_mt.shape)
+    active = np.arange(x_mt.shape[0])
+    for _ in range(max_iter):
+        psd_active = psd[active][:, np.newaxis, :]
+        d_k = psd_active / (eig * psd_active + (1 - eig) * x_var[active, np.newaxis, np.newaxis])
+        d_k *= rt_eig
+
+        not_converged = np.max(np.mean((err[active] - d_k) ** 2, axis=1), axis=-1) >= 1e-10
+        active, d_k = active[not_converged], d_k[not_converged]
+        if len(active) == 0:
+            break
+
+        psd[active] = psd_from_mt(x_mt[active], d_k)
+        err[active] = d_k
+    else:
+        warnings.warn("Iterative multi-taper PSD computation did not converge.")
+
+    return psd
+
+
+def signal_variance(x_mt, eigvals):
+    """
+    Estimate the variance of each signal from its full tapered spectra.
+
+    Parameters
+    ----------
+    x_mt : numpy.ndarray
+        The tapered spectra with shape (..., n_tapers, n_freqs) over all rfft frequencies.
+    eigvals : numpy.ndarray
+        The eigenvalues of the DPSS tapers.
+
+    Returns
+    -------
+    numpy.ndarray
+        The variance of each signal with shape (...).
+    """
+    psd_est = psd_from_mt(x_mt, np.sqrt(eigvals)[:, np.newaxis])
+    return trapezoid(psd_est, dx=np.pi / x_mt.shape[-1]) / (2 * np.pi)
+
+
+def multitaper_band_power(data, sfreq, freq_bands, bandwidth=None, adaptive=True, low_bias=True,
+                          normalization='full', max_iter=250, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Compute the average multitaper power of several frequency bands with a single spectral estimate.
+
+    The data is tapered and transformed once over the union of all the band ranges, and the power of every band
+    is reduced from that spectrum. All the leading dimensions (e.g. trials x channels) are processed together
+    in chunks bounded by ``max_chunk_bytes``. The outputs are the same as calling ``psd_array_multitaper`` once
+    per band and averaging the PSD over frequencies.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The signals with shape (..., n_times), e.g. (trials x channels x timepoints).
+    sfreq : float
+        The sampling frequency.
+    freq_bands : dict
+        Mapping of band name to its (fmin, fmax) range in Hz.
+    bandwidth : float or None
+        Frequency bandwidth of the multitaper window in Hz.
+    adaptive : bool
+        Use adaptive weights to combine the tapered spectra.
+    low_bias : bool
+        Only use tapers with more than 90% spectral concentration within bandwidth.
+    normalization : str
+        Either 'full' or 'length' as in ``psd_array_multitaper``.
+    max_iter : int
+        Maximum number of iterations for the adaptive weights.
+    max_chunk_bytes : int
+        Memory budget of the tapered spectra computed at once.
+
+    Returns
+    -------
+    dict
+        Mapping of band name to its average power with shape data.shape[:-1].
+    """
+    if normalization not in ['full', 'length']:
+        raise ValueError(f"normalization should be 'full' or 'length' but we got {normalization}")
+
+    data = np.asarray(data, dtype=float)
+    n_times = data.shape[-1]
+    data_shape = data.shape[:-1]
+    data = data.reshape(-1, n_times)
+
+    tapers, eigvals = compute_dpss_tapers(n_times, sfreq, bandwidth=bandwidth, low_bias=low_bias)
+    if adaptive and len(eigvals) < 3:
+        warnings.warn(f"Not adaptively combining the spectral estimators due to a low number of tapers "
+                      f"({len(eigvals)} < 3).")
+        adaptive = False
+
+    freqs = rfftfreq(n_times, 1.0 / sfreq)
+    band_masks = {band_name: (freqs >= freq_range[0]) & (freqs <= freq_range[1])
+                  for band_name, freq_range in freq_bands.items()}
+    union_mask = np.logical_or.reduce(list(band_masks.values()))
+
+    band_power = {band_name: np.empty(data.shape[0]) for band_name in freq_bands.keys()}
+    bytes_per_signal = 16 * len(eigvals) * len(freqs)
+    for chunk in signal_chunks(data.shape[0], bytes_per_signal, max_chunk_bytes):
+        x_mt = mt_spectra(data[chunk], tapers)
+        x_var = signal_variance(x_mt, eigvals) if adaptive else None
+        x_mt = x_mt[..., union_mask]
+
+        for band_name, band_mask in band_masks.items():
+            band_mt = x_mt[..., band_mask[union_mask]]
+            if adaptive:
+                psd = psd_from_mt_adaptive(band_mt, eigvals, x_var, max_iter=max_iter)
+            else:
+                psd = psd_from_mt(band_mt, np.sqrt(eigvals)[:, np.newaxis])
+            if normalization == 'full':
+                psd /= sfreq
+            band_power[band_name][chunk] = np.mean(psd, axis=-1)
+
+    return {band_name: power.reshape(data_shape) for band_name, power in band_power.items()}
+
+
+def multitaper_csd(data, sfreq, fmin=0, fmax=np.inf, n_fft=None, bandwidth=None, low_bias=True, freqs=None,
+                   max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Compute the multitaper cross-spectral density averaged over epochs.
+
+    The estimate matches ``mne.time_frequency.csd_array_multitaper`` with ``adaptive=False``.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The time series with shape (..., n_epochs, n_channels, n_times). The CSD is averaged over the epochs and
+        computed independently for every leading dimension.
+    sfreq : float
+        The sampling frequency.
+    fmin : float
+        Minimum frequency of interest.
+    fmax : float
+        Maximum frequency of interest.
+    n_fft : int or None
+        Length of the FFT. If None, the number of samples is used.
+    bandwidth : float or None
+        Frequency bandwidth of the multitaper window in Hz.
+    low_bias : bool
+        Only use tapers with more than 90% spectral concentration within bandwidth.
+    freqs : list of float or None
+        If given, the CSD is only computed at the frequency bins within [fmin, fmax] closest to these frequencies.
+    max_chunk_bytes : int
+        Memory budget of the tapered spectra computed at once.
+
+    Returns
+    -------
+    tuple
+        The CSD with shape (..., n_channels, n_channels, n_freqs) and the frequencies with shape (n_freqs,).
+    """
+    data = np.asarray(data, dtype=float)
+    n_epochs, n_channels, n_times = data.shape[-3:]
+    data_shape = data.shape[:-3]
+    data = data.reshape((-1,) + data.shape[-3:])
+    n_fft = n_times if n_fft is None else n_fft
+
+    tapers, eigvals = compute_dpss_tapers(n_times, sfreq, bandwidth=bandwidth, low_bias=low_bias)
+    weights = np.sqrt(eigvals)[:, np.newaxis]
+
+    all_freqs = rfftfreq(n_fft, 1.0 / sfreq)
+    freq_mask = (all_freqs > 0) & (all_freqs >= fmin) & (all_freqs <= fmax)
+    if not freq_mask.any():
+        raise ValueError("No discrete fourier transform results within the given frequency window. "
+                         "Please widen either the frequency window or the time window")
+
+    freq_idx = np.flatnonzero(freq_mask)
+    if freqs is not None:
+        freq_idx = freq_idx[[np.argmin(np.abs(f - all_freqs[freq_mask])) for f in freqs]]
+
+    csd = np.empty((data.shape[0], n_channels, n_channels, len(freq_idx)), dtype=complex)
+    if freqs is None:
+        bytes_per_signal = 16 * n_epochs * n_channels * len(eigvals) * len(all_freqs)
+    else:
+        bytes_per_signal = 16 * n_epochs * n_channels * len(eigvals) * len(freq_idx)
+    for chunk in signal_chunks(data.shape[0], bytes_per_signal, max_chunk_bytes):
+        if freqs is None:
+            x_mt = mt_spectra(data[chunk], tapers, n_fft=n_fft)[..., freq_idx]
+        else:
+            x_mt = mt_spectra_at(data[chunk], tapers, freq_idx, n_fft=n_fft)
+        x_mt *= weights
+        # Sum over tapers and average over epochs: (chunk, epochs, ch, tapers, freqs) -> (chunk, ch, ch, freqs)
+        csd[chunk] = np.einsum('neikf,nejkf->nijf', x_mt, x_mt.conj()) / n_epochs
+
+    csd *= 2 / np.sum(weights ** 2) / sfreq
+
+    return csd.reshape(data_shape + csd.shape[1:]), all_freqs[freq_idx]
@@ -1,5 +1,5 @@
 import numpy as np
-from mne.time_frequency import csd_array_multitaper
+from src.utils.spectral_matrix.multitaper import multitaper_csd
 
 
 class SpectralMatrixFeatures():
@@ -11,18 +11,21 @@ class SpectralMatrixFeatures():
     def calculate_matrix(self, data, fmin=0, fmax=np.Inf, tmin=None, tmax=None, ch_names=None,
                          n_fft=None, bandwidth=None, adaptive=False, low_bias=True, projs=None, n_jobs=None,
                          verbose=None, desired_freqs=[4, 8, 13, 30]):
-        csd = csd_array_multitaper(data, self.fs,
-                                   fmin=fmin, fmax=fmax,
-                                   ch_names=ch_names,
-                                   n_fft=n_fft, bandwidth=bandwidth, verbose=verbose)
-        freqs = csd.frequencies
-        self.freqs = [freqs[np.argmin(np.abs(f - freqs))] for f in desired_freqs]
-        self.csd = np.stack([csd.get_data(f) for f in self.freqs], axis=-1)
+        """
+        Calculate the multitaper cross-spectral matrix at the frequencies closest to desired_freqs.
+
+        data has shape (epochs x channels x time) or (trials x epochs x channels x time). In the latter case all
+        the trials are computed at once and the matrix has shape (trials x channels x channels x freqs).
+        """
+        csd, freqs = multitaper_csd(data, self.fs, fmin=fmin, fmax=fmax, n_fft=n_fft, bandwidth=bandwidth,
+                                    low_bias=low_bias, freqs=desired_freqs)
+        self.freqs = list(freqs)
+        self.csd = csd
 
     def coherency_matrix(self):
         if self.csd is not None:
-            psd = np.real(np.diagonal(self.csd, axis1=0, axis2=1)).transpose()
-            norm_factor = np.sqrt(psd[:, np.newaxis, :] * psd[np.newaxis, :, :])
+            psd = np.swapaxes(np.real(np.diagonal(self.csd, axis1=-3, axis2=-2)), -1, -2)
+            norm_factor = np.sqrt(psd[..., :, np.newaxis, :] * psd[..., np.newaxis, :, :])
             coh_matrix = np.abs(self.csd) / norm_factor
             coh_tot, coh_ent, coh_vec = self.calculate_svd_metrics(coh_matrix)
             return coh_matrix, coh_tot, coh_ent, coh_vec
@@ -58,24 +61,17 @@ class SpectralMatrixFeatures():
         Calculate metrics based on the singular value decomposition of spectral connectivity data.
 
         Args:
-            spectral_conn: Spectral connectivity data from MNE (output of spectral_connectivity_epochs).
+            sc_data: Spectral connectivity matrix with shape (..., channels, channels, freqs).
 
         Returns:
             Ctot: Ratio of the first singular value to the sum of all singular values for each frequency.
             Cent: Entropy measure for each frequency.
             Cvec: First singular vector for each frequency.
         """
-
-        n_freqs = sc_data.shape[-1]
-        Ctot = np.zeros(n_freqs)
-        Cent = np.zeros(n_freqs)
-        Cvec = np.zeros((n_freqs, sc_data.shape[1]))  # Assuming n_con is the same as the second dimension of sc_data
-
-        for i in range(n_freqs):
-            u, s, vh = np.linalg.svd(sc_data[:, :, i])
-            s = np.diag(s)
-            Ctot[i] = s[0, 0] / np.sum(s)
-            Cent[i] = np.exp(np.mean(np.log(np.diag(s)))) / np.mean(np.diag(s))
-            Cvec[i, :] = u[:, 0]
+        # Stacked SVD over all the leading dimensions and frequencies: (..., freqs, channels, channels)
+        u, s, vh = np.linalg.svd(np.moveaxis(sc_data, -1, -3))
+        Ctot = s[..., 0] / np.sum(s, axis=-1)
+        Cent = np.exp(np.mean(np.log(s), axis=-1)) / np.mean(s, axis=-1)
+        Cvec = u[..., :, 0]
 
         return Ctot, Cent, Cvec
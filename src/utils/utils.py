@@ -1,6 +1,6 @@
 import json
 import os
-from scipy.stats import pointbiserialr
+from scipy import stats
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import OneHotEncoder
@@ -186,18 +186,85 @@ def generate_one_hot_labels(labels_array):
 
 
 def extract_top_correlations(correlation_df, column, nlargest):
-    top_corr = correlation_df[column].abs().nlargest(nlargest)
-    return {column: top_corr.index.tolist()}
+    top_indices = top_k_indices(correlation_df[[column]].values, nlargest)[:, 0]
+    return {column: correlation_df.index[top_indices].tolist()}
 
 
 def get_correlation_multi_event(features_df, target_columns, drop_columns, paths, nlargest=25):
     target_columns = target_columns if isinstance(target_columns, list) else [target_columns]
     correlation_df = calculate_correlations_multi(features_df, target_columns=target_columns, drop_columns=drop_columns)
-    top_correlations = {col: extract_top_correlations(correlation_df, col, nlargest)[col] for col in target_columns}
+    top_indices = top_k_indices(correlation_df[target_columns].values, nlargest)
+    top_correlations = {col: correlation_df.index[top_indices[:, i]].tolist() for i, col in enumerate(target_columns)}
     correlation_df.to_csv(os.path.join(paths.path_result, 'features.csv'))
     return top_correlations
 
 
+class FeatureMatrix:
+    """
+    Contiguous float32 matrix of the numeric feature columns of a patient, with the index of its columns.
+
+    It is built once per patient so that the folds select trials and features with index arrays instead of
+    copying the feature DataFrame.
+
+    Parameters
+    ----------
+    features_df : pandas.DataFrame
+        The features, patient information and labels of the patient.
+    drop_columns : list of str
+        The patient information and label columns, which are not features.
+    """
+
+    def __init__(self, features_df, drop_columns):
+        drop_columns = set(drop_columns)
+        self.columns = [column for column in features_df.columns if column not in drop_columns
+                        and features_df[column].dtype in ['float32', 'float64', 'int64']]
+        self.values = np.ascontiguousarray(features_df[self.columns].to_numpy(dtype=np.float32))
+        self.column_index = pd.Index(self.columns)
+
+    def get_indices(self, columns):
+        """
+        Return the positions of the given feature columns in the matrix.
+        """
+        indices = self.column_index.get_indexer(columns)
+        if np.any(indices < 0):
+            missing = [column for column, index in zip(columns, indices) if index < 0]
+            raise KeyError(f"Features not found in the feature matrix: {missing}")
+        return indices
+
+
+def get_correlation_from_matrix(feature_matrix, train_index, targets, target_columns, paths, nlargest=25):
+    """
+    Rank the features of the training trials by their absolute correlation with each target.
+
+    Parameters
+    ----------
+    feature_matrix : FeatureMatrix
+        The feature matrix of the patient.
+    train_index : numpy.ndarray
+        The positions of the training trials.
+    targets : numpy.ndarray
+        The targets of the training trials, with shape (n_train,) or (n_train, n_targets).
+    target_columns : list of str
+        The names of the targets.
+    paths : Paths
+        The paths object; the correlations are saved to features.csv in paths.path_result.
+    nlargest : int
+        The number of features to keep per target.
+
+    Returns
+    -------
+    dict
+        The names of the most correlated features of each target.
+    """
+    correlations = np.nan_to_num(correlation_matrix(feature_matrix.values[train_index], targets))
+    correlation_df = pd.DataFrame(correlations, index=feature_matrix.columns, columns=target_columns)
+    correlation_df.to_csv(os.path.join(paths.path_result, 'features.csv'))
+
+    top_indices = top_k_indices(correlations, nlargest)
+    return {column: [feature_matrix.columns[index] for index in top_indices[:, i]]
+            for i, column in enumerate(target_columns)}
+
+
 def get_correlation_single_event(features_df, single_event_target, drop_columns, paths, nlargest=25):
     single_event_target = single_event_target[0] if isinstance(single_event_target, list) else single_event_target
     correlation_df = calculate_correlations_single(features_df, drop_columns=drop_columns,
@@ -207,105 +274,268 @@ def get_correlation_single_event(features_df, single_event_target, drop_columns,
     return top_correlations
 
 
+def correlation_matrix(features, targets, return_p_values=False, dtype=np.float64):
+    """
+    Compute the Pearson (point-biserial for binary targets) correlation of every feature with every target.
+
+    The features and targets are z-scored once and all the correlations are obtained with one matrix product.
+    Constant columns have no defined correlation and get NaN, as with scipy.stats.pointbiserialr.
+
+    Parameters
+    ----------
+    features : numpy.ndarray
+        The feature matrix, with shape (n_samples, n_features).
+    targets : numpy.ndarray
+        The target matrix, with shape (n_samples, n_targets), or a single target with shape (n_samples,).
+    return_p_values : bool
+        If True, also return the two-sided p-values of the correlations.
+    dtype : numpy.dtype
+        The floating point type of the computation (float32 is faster on large matrices).
+
+    Returns
+    -------
+    numpy.ndarray or tuple
+        The correlations with shape (n_features, n_targets) and, if requested, the p-values with the same shape.
+    """
+    features = np.asarray(features, dtype=dtype)
+    targets = np.asarray(targets, dtype=dtype)
+    if targets.ndim == 1:
+        targets = targets[:, None]
+
+    def standardize(matrix):
+        centered = matrix - matrix.mean(axis=0)
+        norm = np.sqrt(np.einsum('ij,ij->j', centered, centered))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return centered / np.where(norm > 0, norm, np.nan)
+
+    correlations = np.clip(standardize(features).T @ standardize(targets), -1, 1)
+    if not return_p_values:
+        return correlations
+
+    degrees_of_freedom = features.shape[0] - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_statistic = correlations * np.sqrt(degrees_of_freedom / ((1 - correlations) * (1 + correlations)))
+    p_values = 2 * stats.t.sf(np.abs(t_statistic), degrees_of_freedom)
+    return correlations, p_values
+
+
+def top_k_indices(scores, k):
+    """
+    Find the indices of the k largest absolute scores of every column.
+
+    Parameters
+    ----------
+    scores : numpy.ndarray
+        The scores, with shape (n_items, n_columns).
+    k : int
+        The number of indices to keep per column.
+
+    Returns
+    -------
+    numpy.ndarray
+        The indices with shape (min(k, n_items), n_columns), sorted by decreasing absolute score; ties keep the
+        order of the items, as pandas nlargest.
+    """
+    abs_scores = np.nan_to_num(np.abs(scores), nan=-np.inf)
+    n_items = abs_scores.shape[0]
+    k = min(k, n_items)
+    if k < n_items:
+        candidates = np.argpartition(-abs_scores, k - 1, axis=0)[:k]
+    else:
+        candidates = np.broadcast_to(np.arange(n_items)[:, None], abs_scores.shape)
+
+    top_indices = np.empty((k, abs_scores.shape[1]), dtype=int)
+    for column in range(abs_scores.shape[1]):
+        column_candidates = candidates[:, column]
+        order = np.lexsort((column_candidates, -abs_scores[column_candidates, column]))
+        top_indices[:, column] = column_candidates[order]
+    return top_indices
+
+
 def calculate_correlations_multi(features_df, target_columns, drop_columns):
-    correlation_df = pd.DataFrame(index=[feature for feature in features_df.columns if feature not in drop_columns],
-                                  columns=target_columns)
+    feature_columns = [feature for feature in features_df.columns if feature not in drop_columns]
+    numeric_columns = [column for column in feature_columns
+                       if features_df[column].dtype in ['float32', 'float64', 'int64']]
 
-    for binary_column in target_columns:
-        for column in features_df.columns:
-            if column not in drop_columns and features_df[column].dtype in ['float64', 'int64']:
-                corr, _ = pointbiserialr(features_df[column], features_df[binary_column])
-                correlation_df.loc[column, binary_column] = corr
+    correlations = correlation_matrix(features_df[numeric_columns].values, features_df[target_columns].values)
+    correlation_df = pd.DataFrame(correlations, index=numeric_columns, columns=target_columns)
 
-    return correlation_df.apply(pd.to_numeric, errors='coerce').fillna(0)
+    return correlation_df.reindex(feature_columns).fillna(0)
 
 
 def calculate_correlations_single(features_df, single_event_target_column, drop_columns):
-    correlation_df = pd.DataFrame(index=[feature for feature in features_df.columns if feature not in drop_columns],
-                                  columns=[single_event_target_column])
+    feature_columns = [feature for feature in features_df.columns if feature not in drop_columns]
 
-    for column in features_df.columns:
-        if column not in drop_columns:
-            corr, _ = pointbiserialr(features_df[column], features_df[single_event_target_column])
-            correlation_df.loc[column, single_event_target_column] = corr
+    correlations = correlation_matrix(features_df[feature_columns].values,
+                                      features_df[single_event_target_column].values)
+    correlation_df = pd.DataFrame(correlations, index=feature_columns, columns=[single_event_target_column])
 
-    return correlation_df.apply(pd.to_numeric, errors='coerce').fillna(0)
+    return correlation_df.fillna(0)
 
 
 def remove_duplicates(input_list):
     return list(dict.fromkeys(input_list))
 
 
+PRE_SELECTED_FEATURES = [
+    'reaction_time', 'D17-time_post_p300', 'A18-time_post_p300', 'D27-time_post_p300',
+    'C8-time_post_p300', 'A6-time_post_p300', 'A5-time_post_p300',
+    'A17-time_post_p300', 'A19-time_post_p300', 'D16-time_post_p300',
+    'C6-time_post_p300', 'C10-time_post_p300', 'C7-time_post_p300',
+    'C31-time_post_p300', 'C5-time_p300', 'A7-time_post_p300', 'D28-time_post_p300',
+    'D30-time_post_p300', 'C15-time_post_p300', 'D7-time_post_p300',
+    'B19-time_post_p300', 'A16-time_post_p300', 'C14-time_post_p300',
+    'D19-time_post_p300', 'B10-time_post_p300'
+]
+
+
 def get_selected_features(features_df, settings, paths, fold_idx, train_index,
                           pre_selected_features=None,
-                          target_columns_drop=None, num_important_features=25):
+                          target_columns_drop=None, num_important_features=25, scaler=None, feature_matrix=None):
+    """
+    Select the features of a fold and scale them with statistics of the training trials.
+
+    features_df is not modified. Passing the FeatureMatrix of the patient for all its folds avoids converting the
+    features again.
+    """
     target_columns_drop = target_columns_drop or ['id', 'old_new', 'decision', 'subject_file']
-    pre_selected_features = pre_selected_features or [
-        'reaction_time', 'D17-time_post_p300', 'A18-time_post_p300', 'D27-time_post_p300',
-        'C8-time_post_p300', 'A6-time_post_p300', 'A5-time_post_p300',
-        'A17-time_post_p300', 'A19-time_post_p300', 'D16-time_post_p300',
-        'C6-time_post_p300', 'C10-time_post_p300', 'C7-time_post_p300',
-        'C31-time_post_p300', 'C5-time_p300', 'A7-time_post_p300', 'D28-time_post_p300',
-        'D30-time_post_p300', 'C15-time_post_p300', 'D7-time_post_p300',
-        'B19-time_post_p300', 'A16-time_post_p300', 'C14-time_post_p300',
-        'D19-time_post_p300', 'B10-time_post_p300'
-    ]
+    feature_matrix = feature_matrix or FeatureMatrix(features_df, target_columns_drop)
+    column_indices, selected_features = get_selected_feature_indices(
+        features_df, settings, paths, fold_idx, train_index, pre_selected_features=pre_selected_features,
+        target_columns_drop=target_columns_drop, num_important_features=num_important_features,
+        feature_matrix=feature_matrix)
+
+    patients_ids = features_df['id'].values
+    patients_files = features_df['subject_file'].values[0]
+    features_matrix = feature_matrix.values[:, column_indices]
+
+    scaler = scaler or FeatureScaler(settings.feature_transformation)
+    scaler.fit(features_matrix[train_index])
+    features_matrix = scaler.transform(features_matrix)
+
+    return features_matrix, selected_features, patients_ids, patients_files
+
+
+def get_selected_feature_indices(features_df, settings, paths, fold_idx, train_index, pre_selected_features=None,
+                                 target_columns_drop=None, num_important_features=25, feature_matrix=None):
+    """
+    Select the features of a fold and locate them in the feature matrix of the patient.
+
+    The selected features are saved to features_fold<fold>.json in paths.path_result, as in get_selected_features,
+    but the feature matrix is neither copied nor scaled, so that the folds can be sliced from it when needed.
+
+    Returns
+    -------
+    tuple
+        The positions of the selected features in feature_matrix (without duplicates) and the selected features
+        of each target.
+    """
+    target_columns_drop = target_columns_drop or ['id', 'old_new', 'decision', 'subject_file']
+    pre_selected_features = pre_selected_features or PRE_SELECTED_FEATURES
+    feature_matrix = feature_matrix or FeatureMatrix(features_df, target_columns_drop)
 
     selected_features = select_features(features_df, settings=settings, paths=paths, fold_idx=fold_idx,
                                         train_index=train_index,
                                         pre_selected_features=pre_selected_features,
                                         drop_columns=target_columns_drop,
-                                        nlargest=num_important_features)
+                                        nlargest=num_important_features,
+                                        feature_matrix=feature_matrix)
 
     with open(os.path.join(paths.path_result, f'features_fold{fold_idx + 1}.json'), "w") as file:
         json.dump(selected_features, file, indent=2)
 
-    patients_ids = features_df['id'].values
-    patients_files = features_df['subject_file'].values[0]
-    features_df.drop(target_columns_drop, axis=1, inplace=True)
-    selected_features_all = list({feature for key in selected_features for feature in selected_features[key]})
-    features_df = transform_features(features_df, settings)
-    features_matrix = features_df[selected_features_all].values
-
-    return features_matrix, selected_features, patients_ids, patients_files
+    selected_features_all = remove_duplicates([feature for key in selected_features
+                                               for feature in selected_features[key]])
+    return feature_matrix.get_indices(selected_features_all), selected_features
 
 
-def select_features(features_df, settings, paths, fold_idx, train_index, pre_selected_features, drop_columns, nlargest=25):
+def select_features(features_df, settings, paths, fold_idx, train_index, pre_selected_features, drop_columns, nlargest=25,
+                    feature_matrix=None):
     method = settings.features_selection_method.lower()
     correlation_mode = settings.correlation_mode  # Default to 'multi'
+    feature_matrix = feature_matrix or FeatureMatrix(features_df, drop_columns)
 
     if method == 'all':
-        features_list = [feature for feature in features_df.columns.to_list() if feature not in drop_columns]
-        return {'all': features_list}
+        return {'all': list(feature_matrix.columns)}
     elif method == 'corr':
         if correlation_mode == 'multi':
-            return get_correlation_multi_event(features_df.reset_index(drop=True).loc[train_index].copy(),
-                                               target_columns=settings.target_column,
-                                               drop_columns=drop_columns,
-                                               paths=paths, nlargest=nlargest)
+            target_columns = settings.target_column
+            target_columns = target_columns if isinstance(target_columns, list) else [target_columns]
         elif correlation_mode == 'single':
-            return get_correlation_single_event(features_df.reset_index(drop=True).loc[train_index].copy(),
-                                                drop_columns=drop_columns,
-                                                single_event_target=settings.single_event_target,
-                                                paths=paths,
-                                                nlargest=nlargest)
+            single_event_target = settings.single_event_target
+            target_columns = [single_event_target[0] if isinstance(single_event_target, list) else single_event_target]
         else:
             raise ValueError("Invalid correlation mode")
+        targets = features_df[target_columns].to_numpy()[train_index]
+        return get_correlation_from_matrix(feature_matrix, train_index, targets, target_columns, paths,
+                                           nlargest=nlargest)
     elif method == 'pre_selected':
         return {'all': pre_selected_features}
     else:
         raise ValueError("Invalid feature selection method")
 
 
-def transform_features(features_df, settings):
-    transformation = settings.feature_transformation
+class FeatureScaler:
+    """
+    Min-max normalization or standardization of feature matrices with statistics fitted on training trials.
 
-    if transformation is None:
-        return features_df
+    The statistics are computed with NumPy on the selected feature columns only.
 
-    if transformation.lower() == 'normalize':
-        return features_df.apply(lambda x: (x - x.min()) / (x.max() - x.min()))
-    elif transformation.lower() == 'standardize':
-        return features_df.apply(lambda x: (x - x.mean()) / x.std())
-    else:
-        raise ValueError("Undefined transformation method")
+    Parameters
+    ----------
+    transformation : str or None
+        'normalize' (min-max), 'standardize' (zero mean, unit standard deviation), or None (no scaling).
+    """
+
+    def __init__(self, transformation):
+        if transformation is not None and transformation.lower() not in ['normalize', 'standardize']:
+            raise ValueError("Undefined transformation method")
+        self.transformation = None if transformation is None else transformation.lower()
+        self.offset = None
+        self.scale = None
+
+    def fit(self, features):
+        """
+        Compute the scaling statistics of the features.
+
+        Parameters
+        ----------
+        features : numpy.ndarray
+            The training features, with shape (n_trials, n_features).
+
+        Returns
+        -------
+        FeatureScaler
+            The fitted scaler.
+        """
+        if self.transformation == 'normalize':
+            offset = np.nanmin(features, axis=0)
+            scale = np.nanmax(features, axis=0) - offset
+        elif self.transformation == 'standardize':
+            offset = np.nanmean(features, axis=0)
+            scale = np.nanstd(features, axis=0, ddof=1)
+        else:
+            offset, scale = 0, 1
+        # Features that are constant on the training trials are only shifted
+        scale = np.where(scale > 0, scale, 1) if self.transformation is not None else scale
+
+        self.offset, self.scale = offset, scale
+        return self
+
+    def transform(self, features):
+        """
+        Scale features with the fitted statistics.
+
+        Parameters
+        ----------
+        features : numpy.ndarray
+            The features, with shape (n_trials, n_features).
+
+        Returns
+        -------
+        numpy.ndarray
+            The scaled features.
+        """
+        if self.transformation is None:
+            return features
+        return (features - self.offset) / self.scale